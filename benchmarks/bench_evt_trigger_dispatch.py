@@ -0,0 +1,114 @@
+#-*- coding:utf-8 -*-
+
+"""
+Benchmark of the Python overhead per trigger in `EvtTrigger`.
+
+The dispatch of the former `run()`, which compared the output mode against
+four strings and looked up the device and its state on every trigger, is
+compared with the callable that `prepare()` now compiles. A stub device
+replaces the EVT hardware, so only the Python overhead is measured.
+
+Run from the repository root in the OpenSesame Python environment:
+
+    python benchmarks/bench_evt_trigger_dispatch.py
+
+No EVT device needs to be connected.
+"""
+
+import statistics
+from time import perf_counter_ns
+
+from libopensesame.experiment import Experiment
+from libopensesame.oslogging import oslogger
+from opensesame_plugins.evt_plugins import _devices
+from opensesame_plugins.evt_plugins.evt_trigger import evt_trigger
+from opensesame_plugins.evt_plugins.evt_trigger.evt_trigger import (
+    EvtTrigger, device_output_value)
+
+N_TRIGGERS = 20000
+N_REPEATS = 7
+MODES = (u'Clear output lines', u'Write output lines', u'Invert output lines',
+         u'Pulse output lines')
+PRODUCT_STRING = u'EventExchanger-EVT2'
+SELECTION = u'EVT2 s/n: 0000'
+
+
+class _StubDevice:
+
+    def write_lines(self, value):
+        pass
+
+    def pulse_lines(self, value, duration):
+        pass
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return u'stub'
+
+
+def _register_stub():
+    key = PRODUCT_STRING + u' s/n: 0000'
+    _devices.open_devices[key] = _StubDevice()
+    _devices._product_strings[key] = PRODUCT_STRING
+    _devices._selections[evt_trigger._DEVICE_GROUP, SELECTION] = key
+
+
+def legacy_dispatch(self):
+    """The dispatch of the former EvtTrigger.run(), for the attached device."""
+    open_devices = _devices.open_devices
+    if self.var.outputmode == u'Clear output lines':
+        device_output_value[self.current_device] = 0
+        open_devices[self.current_device].write_lines(device_output_value[self.current_device])
+        oslogger.info('{}: send byte code {}'.format(
+            open_devices[self.current_device], device_output_value[self.current_device]))
+    elif self.var.outputmode == u'Write output lines':
+        device_output_value[self.current_device] = self.var.mask
+        open_devices[self.current_device].write_lines(device_output_value[self.current_device])
+        oslogger.info('{}: send byte code {}'.format(
+            open_devices[self.current_device], device_output_value[self.current_device]))
+    elif self.var.outputmode == u'Invert output lines':
+        device_output_value[self.current_device] ^= self.var.mask
+        open_devices[self.current_device].write_lines(device_output_value[self.current_device])
+        oslogger.info('{}: send byte code {}'.format(
+            open_devices[self.current_device], device_output_value[self.current_device]))
+    elif self.var.outputmode == u'Pulse output lines':
+        open_devices[self.current_device].pulse_lines(
+            (device_output_value[self.current_device] ^ self.var.mask), self.var.duration)
+        oslogger.info('{}: send byte code {} for the duration of {} ms'.format(
+            open_devices[self.current_device],
+            device_output_value[self.current_device] ^ self.var.mask, self.var.duration))
+    # the former run() also checked whether to close the device:
+    if self.var.close_device == 'yes':
+        pass
+
+
+def _per_trigger(func):
+    """Returns the median time per call in µs."""
+    results = []
+    for i in range(N_REPEATS):
+        t0 = perf_counter_ns()
+        for j in range(N_TRIGGERS):
+            func()
+        results.append((perf_counter_ns() - t0) / N_TRIGGERS / 1000)
+    return statistics.median(results)
+
+
+def main():
+    _register_stub()
+    experiment = Experiment()
+    item = EvtTrigger(u'evt_trigger', experiment)
+    item.var.device = SELECTION
+    item.var.mask = 5
+    print('{:22} {:>12} {:>14}'.format('mode', 'before [µs]', 'after [µs]'))
+    for mode in MODES:
+        item.var.outputmode = mode
+        item.prepare()
+        before = _per_trigger(lambda: legacy_dispatch(item))
+        after = _per_trigger(item.send)
+        print('{:22} {:12.3f} {:14.3f}'.format(mode, before, after))
+
+
+if __name__ == '__main__':
+    main()
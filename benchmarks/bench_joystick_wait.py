@@ -0,0 +1,98 @@
+#-*- coding:utf-8 -*-
+
+"""
+Benchmark of the wait strategies of the pygame joystick back-end.
+
+For every wait strategy, a helper thread posts joystick button events at
+random intervals while `Legacy.get_joybutton()` waits for them. The script
+reports the CPU load during the wait and the latency between posting the
+event and the return of `get_joybutton()`.
+
+Run from the repository root in the OpenSesame Python environment:
+
+    python benchmarks/bench_joystick_wait.py
+
+No joystick needs to be connected.
+"""
+
+import os
+import random
+import statistics
+import threading
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+from opensesame_plugins.evt_plugins.rsp_pygame._libjoystick.legacy import Legacy
+from opensesame_plugins.evt_plugins.rsp_pygame._libjoystick.eventpump import event_pump
+
+N_TRIALS = 50
+MIN_DELAY = 0.02 # s
+MAX_DELAY = 0.1 # s
+
+
+class _Experiment:
+
+    def pause(self):
+        pass
+
+
+def _make_joystick(wait_strategy):
+    # Bypass __init__(), which needs a connected joystick.
+    joystick = Legacy.__new__(Legacy)
+    joystick.experiment = _Experiment()
+    joystick._pump = event_pump
+    joystick._instance_id = 0
+    event_pump.register(0)
+    joystick._clock_offset = 0.0
+    joystick.set_joybuttonlist(None)
+    joystick.set_timeout(None)
+    joystick.set_wait_strategy(wait_strategy)
+    return joystick
+
+
+def _post_later(delay, post_times):
+    time.sleep(delay)
+    post_times.append(time.perf_counter())
+    pygame.event.post(pygame.event.Event(pygame.JOYBUTTONDOWN, button=0, joy=0,
+                                         instance_id=0))
+
+
+def bench(wait_strategy):
+    joystick = _make_joystick(wait_strategy)
+    latencies = []
+    cpu = 0.0
+    wall = 0.0
+    for i in range(N_TRIALS):
+        pygame.event.clear()
+        post_times = []
+        poster = threading.Thread(target=_post_later, args=(
+            random.uniform(MIN_DELAY, MAX_DELAY), post_times))
+        t_wall = time.perf_counter()
+        t_cpu = time.process_time()
+        poster.start()
+        joystick.get_joybutton(timeout=1000)
+        t_return = time.perf_counter()
+        cpu += time.process_time() - t_cpu
+        wall += t_return - t_wall
+        poster.join()
+        latencies.append(1000 * (t_return - post_times[0]))
+    latencies.sort()
+    return (100 * cpu / wall, statistics.median(latencies),
+            latencies[int(.99 * (len(latencies) - 1))], latencies[-1])
+
+
+def main():
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    print('{:10} {:>8} {:>14} {:>11} {:>11}'.format(
+        'strategy', 'CPU [%]', 'median [ms]', 'p99 [ms]', 'max [ms]'))
+    for wait_strategy in (u'spin', u'hybrid', u'blocking'):
+        print('{:10} {:8.1f} {:14.3f} {:11.3f} {:11.3f}'.format(
+            wait_strategy, *bench(wait_strategy)))
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
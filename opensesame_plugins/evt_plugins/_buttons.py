@@ -0,0 +1,45 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from libopensesame.py3compat import *
+
+
+def button_table(allowed_event_lines):
+    """Builds a lookup table to decode the button mask of a response box.
+
+    Parameters
+    ----------
+    allowed_event_lines : int
+        Bit mask [0-255] of the allowed buttons.
+
+    Returns
+    -------
+    list
+        A list with an entry for every mask 0-255. Each entry is a
+        (button, buttons, allowed) tuple. `button` is the lowest allowed
+        button that is pressed, or -1 if none. `buttons` is the list of all
+        pressed buttons (1-8) and `allowed` tells whether the mask contains
+        an allowed button.
+    """
+    table = []
+    for mask in range(256):
+        buttons = [b + 1 for b in range(8) if mask >> b & 1]
+        allowed = [b + 1 for b in range(8) if (mask & allowed_event_lines) >> b & 1]
+        table.append((allowed[0] if allowed else -1, buttons, len(allowed) > 0))
+    return table
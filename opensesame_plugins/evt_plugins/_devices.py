@@ -0,0 +1,401 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import (sleep, perf_counter)
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+import hid
+from pyevt import EventExchanger
+from ._reader import EventReader
+from ._writer import TriggerWriter
+from ._latency import (InstrumentedDevice, device_histograms, publish_latencies,
+    write_latencies)
+
+# constant
+_SCAN_KEY = u'EventExchanger' # common part of the product string of all EVT devices.
+_RETRIES = 5 # max. number of retries for scanning and attaching.
+_BACKOFF = 0.05 # first retry delay in seconds, doubled on every retry.
+_ATTACH_WORKERS = 4 # max. number of devices that are attached concurrently.
+_LATENCY_SUFFIX = u'_evt_latency.csv'
+_CACHE_FILE = os.path.join(os.path.expanduser(u'~'), u'.evt_plugins', u'device_cache.json')
+
+# global var
+_lock = threading.RLock()
+open_devices = {} # Store open device handles, shared by all EVT plug-ins.
+_product_strings = {} # Store the product string belonging to each attached device.
+_closed = set() # Keys of the devices that were closed and not attached again.
+_selections = {} # Cache of (device group, selection) to device key lookups.
+_readers = {} # Store the running background readers of the open devices.
+_writers = {} # Store the running background writers of the open devices.
+_histograms = None # Latency histograms per device while the calls are measured.
+
+
+def composed_string(d):
+    """Returns the registry key for a device dict as returned by
+    `EventExchanger.scan()`."""
+    return d['product_string'] + " s/n: " + d['serial_number']
+
+
+def _device_tuples(device_list):
+    """Returns the (product_string, serial_number, path) tuples of a device
+    list in a JSON compatible form."""
+    return [[d['product_string'], d['serial_number'],
+             d['path'].decode('latin-1') if isinstance(d['path'], bytes) else d['path']]
+            for d in device_list]
+
+
+def _load_cache():
+    try:
+        with open(_CACHE_FILE) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_cache(device_list):
+    try:
+        os.makedirs(os.path.dirname(_CACHE_FILE), exist_ok=True)
+        with open(_CACHE_FILE, 'w') as fd:
+            json.dump(_device_tuples(device_list), fd)
+    except OSError:
+        oslogger.warning('Could not write the EVT device cache: {}'.format(_CACHE_FILE))
+
+
+def _scan():
+    """Scans the HID bus for EVT devices.
+
+    When the first scan matches the device configuration of the previous
+    session, as stored in the on-disk cache, the list is returned directly.
+    Otherwise the scan is repeated until two successive scans agree,
+    because right after start-up the device list is not always complete.
+    The number of retries is bounded and the delay between the retries
+    backs off.
+    """
+    temp_evt = EventExchanger()
+    device_list = temp_evt.scan(_SCAN_KEY)
+    if len(device_list) > 0 and _device_tuples(device_list) == _load_cache():
+        del temp_evt
+        return device_list
+    delay = _BACKOFF
+    for attempt in range(_RETRIES):
+        sleep(delay)
+        delay *= 2
+        new_list = temp_evt.scan(_SCAN_KEY)
+        if len(new_list) > 0 and \
+                [d['path'] for d in new_list] == [d['path'] for d in device_list]:
+            break
+        device_list = new_list
+    del temp_evt
+    _save_cache(device_list)
+    return device_list
+
+
+def scan_devices(device_group=None):
+    """Lists the connected devices of a device group without attaching
+    them.
+
+    Parameters
+    ----------
+    device_group : str, NoneType, optional
+        The device group to filter on, e.g. u'EVT' or u'RSP', or `None`
+        to list all EVT devices.
+
+    Returns
+    -------
+    list
+        A list of device dicts as returned by `EventExchanger.scan()`.
+    """
+    if device_group is None:
+        return _scan()
+    return [d for d in _scan()
+            if device_group.lower() in d['product_string'].lower()]
+
+
+def _attach(d):
+    """Attaches a single device by the path from the scan and retries with
+    back-off until the device opens. The device is opened directly instead
+    of by `attach_id()`, which enumerates the whole HID bus again for every
+    device.
+
+    Returns
+    -------
+    tuple
+        An (EventExchanger, attach time in ms) tuple. The EventExchanger is
+        `None` when the device could not be attached.
+    """
+    t0 = perf_counter()
+    delay = _BACKOFF
+    for attempt in range(_RETRIES + 1):
+        if attempt > 0:
+            sleep(delay)
+            delay *= 2
+        device = hid.device()
+        try:
+            device.open_path(d['path'])
+            device.set_nonblocking(True)
+        except (IOError, OSError):
+            device.close() # also when set_nonblocking() failed on an open device.
+            continue
+        evt = EventExchanger()
+        evt.device = device
+        return evt, 1000 * (perf_counter() - t0)
+    return None, 1000 * (perf_counter() - t0)
+
+
+def _in_group(key, device_group):
+    """Returns whether an attached device belongs to a device group. All
+    devices belong to the device group `None`."""
+    return device_group is None or \
+        device_group.lower() in _product_strings[key].lower()
+
+
+def attach_devices(device_group=None):
+    """Scans the HID bus once and attaches all connected EVT devices that
+    are not attached yet.
+
+    The bus is only scanned again when no device of the device group is
+    attached, or when a device of the group was closed. So all plug-in
+    instances after the first one get their handle without scanning, and
+    a closed device is attached again on the next prepare. The devices are
+    attached concurrently.
+
+    Parameters
+    ----------
+    device_group : str, NoneType, optional
+        The device group that is needed, e.g. u'EVT' or u'RSP', or `None`
+        for any device.
+
+    Returns
+    -------
+    dict
+        The shared dictionary with open device handles.
+    """
+    with _lock:
+        if any(_in_group(dkey, device_group) for dkey in open_devices) and \
+                not any(_in_group(dkey, device_group) for dkey in _closed):
+            return open_devices
+        device_list = [d for d in _scan() if composed_string(d) not in open_devices]
+        _closed.clear() # attached again below, or no longer connected.
+        if len(device_list) == 0:
+            return open_devices
+        with ThreadPoolExecutor(
+                max_workers=min(_ATTACH_WORKERS, len(device_list))) as pool:
+            results = list(pool.map(_attach, device_list))
+        for d, (evt, attach_time) in zip(device_list, results):
+            if evt is None:
+                oslogger.warning('Attaching device {} s/n: {} failed after {:.1f} ms!'.format(
+                    d['product_string'], d['serial_number'], attach_time))
+                continue
+            key = composed_string(d)
+            open_devices[key] = _instrumented(key, evt)
+            _product_strings[key] = d['product_string']
+            oslogger.info('Device successfully attached as: {} s/n: {} in {:.1f} ms'.format(
+                d['product_string'], d['serial_number'], attach_time))
+            oslogger.info('        ...  and with device ID: {}'.format(
+                open_devices[key]))
+        _selections.clear()
+        return open_devices
+
+
+def _instrumented(key, evt):
+    """Returns the handle, wrapped to measure its calls when that is
+    enabled."""
+    if _histograms is None:
+        return evt
+    return InstrumentedDevice(evt, _histograms.setdefault(key, device_histograms()))
+
+
+def instrument_devices(experiment):
+    """Measures the duration of the device calls of the plug-ins when the
+    experiment variable `evt_latency` is set to 'yes'. The open handles, also
+    those of the running writers, and the handles that are attached later
+    are wrapped. The statistics so far are stored in experiment variables on
+    every call, so that a logger can log them, and are written to
+    `[logfile name]_evt_latency.csv` at the end of the experiment. Call this
+    in prepare(), before the device is looked up."""
+    global _histograms
+    with _lock:
+        if experiment.var.get(u'evt_latency', default=u'no') == u'yes':
+            histograms = getattr(experiment, u'evt_latency', None)
+            if histograms is None:
+                histograms = experiment.evt_latency = {}
+                path = os.path.splitext(experiment.logfile or u'subject')[0] + \
+                    _LATENCY_SUFFIX
+                experiment.cleanup_functions.append(
+                    lambda: write_latencies(path, histograms))
+            if _histograms is not histograms:
+                _histograms = histograms
+                for key, evt in open_devices.items():
+                    if isinstance(evt, InstrumentedDevice):
+                        evt = evt.handle # measured for a previous experiment.
+                    _replace_handle(key, _instrumented(key, evt))
+            publish_latencies(experiment, histograms)
+        elif _histograms is not None:
+            _histograms = None
+            for key, evt in open_devices.items():
+                if isinstance(evt, InstrumentedDevice):
+                    _replace_handle(key, evt.handle)
+
+
+def _replace_handle(key, evt):
+    """Replaces the handle of an open device, also in its writer. The reader
+    only uses the HID device of the handle, which stays the same."""
+    open_devices[key] = evt
+    if key in _writers:
+        _writers[key].replace_handle(evt)
+
+
+def find_device(device_group, selection):
+    """Finds the attached device that belongs to a device selection.
+
+    Parameters
+    ----------
+    device_group : str
+        The device group to filter on, e.g. u'EVT' or u'RSP'.
+    selection : str
+        The device string as selected in the device combobox.
+
+    Returns
+    -------
+    str, NoneType
+        The key of the device in `open_devices` or `None` if the device
+        is not attached.
+    """
+    with _lock:
+        try:
+            return _selections[device_group, selection]
+        except KeyError:
+            pass
+        attach_devices(device_group)
+        current_device = None
+        for dkey in open_devices:
+            # The selection is the key without the common u'EventExchanger-'
+            # part, so the serial number tells devices of the same model apart.
+            if _in_group(dkey, device_group) and dkey[15:] == selection:
+                current_device = dkey
+        if current_device is not None:
+            _selections[device_group, selection] = current_device
+        return current_device
+
+
+def group_devices(device_group):
+    """Returns the keys of all attached devices of a device group."""
+    with _lock:
+        attach_devices(device_group)
+        return [dkey for dkey in open_devices if _in_group(dkey, device_group)]
+
+
+def event_reader(key, start=True):
+    """Returns the background reader of an attached device.
+
+    Parameters
+    ----------
+    key : str
+        The key of the device in `open_devices`.
+    start : bool, optional
+        Start a reader when the device does not have one yet.
+
+    Returns
+    -------
+    EventReader, NoneType
+        The running reader or `None` if there is none and `start` is
+        `False`.
+    """
+    with _lock:
+        reader = _readers.get(key)
+        if reader is not None and reader.closed:
+            del _readers[key] # ended on a read error, start a new one.
+            reader = None
+        if reader is None and start:
+            reader = EventReader(open_devices[key])
+            reader.start()
+            _readers[key] = reader
+            oslogger.info('Background reader started for: {}'.format(key))
+        return reader
+
+
+def trigger_writer(key, start=True):
+    """Returns the background writer of an attached device.
+
+    Parameters
+    ----------
+    key : str
+        The key of the device in `open_devices`.
+    start : bool, optional
+        Start a writer when the device does not have one yet.
+
+    Returns
+    -------
+    TriggerWriter, NoneType
+        The running writer or `None` if there is none and `start` is
+        `False`.
+    """
+    with _lock:
+        writer = _writers.get(key)
+        if writer is not None and writer.closed:
+            del _writers[key] # ended unexpectedly, start a new one.
+            writer = None
+        if writer is None and start:
+            writer = TriggerWriter(open_devices[key])
+            writer.start()
+            _writers[key] = writer
+            oslogger.info('Background writer started for: {}'.format(key))
+        return writer
+
+
+def stop_writers():
+    """Completes the queued writes and stops all background writers. This
+    is registered as the first cleanup function of the experiment, so that
+    no write is logged after the event log has been closed."""
+    with _lock:
+        for key in list(_writers):
+            _writers.pop(key).stop()
+
+
+def close_devices(keys):
+    """Closes attached devices and removes them from the registry, so that
+    they are attached again on the next prepare. Only the devices of the
+    calling item are closed, so the other items keep their devices.
+
+    Parameters
+    ----------
+    keys : list
+        The keys of the devices in `open_devices`. Keys of devices that are
+        not attached, or `None`, are skipped.
+    """
+    with _lock:
+        for dkey in keys:
+            if dkey not in open_devices:
+                continue
+            if dkey in _readers:
+                _readers.pop(dkey).stop()
+            if dkey in _writers:
+                _writers.pop(dkey).stop() # completes the queued writes first.
+            try:
+                open_devices[dkey].close()
+                oslogger.info('Device: {} successfully closed!'.format(open_devices[dkey]))
+            except:
+                oslogger.warning('Device {} for closing not found!'.format(open_devices[dkey]))
+            del open_devices[dkey]
+            _closed.add(dkey)
+        _selections.clear()
@@ -0,0 +1,210 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+from ._journal import Journal
+
+# constant
+_BUFFER_SIZE = 8192 # number of events that are buffered before a flush.
+_SUFFIX = u'_evt_events.csv'
+_JOURNAL_SUFFIX = u'_evt_journal.bin'
+_HEADER = u't_ns,plugin,device,kind,value,duration\n'
+
+# event kinds, the trigger kinds are the write operations of the writer.
+RESPONSE = 3
+LED = 4
+STIMULUS = 5
+KIND_NAMES = (u'write', u'pulse', u'sequence', u'response', u'led', u'stimulus')
+
+
+class _Buffer:
+    """A preallocated block of event records, stored column-wise."""
+
+    def __init__(self, size):
+        self.t = array('q', bytes(8 * size))
+        self.plugin = array('H', bytes(2 * size))
+        self.device = array('H', bytes(2 * size))
+        self.kind = array('B', bytes(size))
+        self.value = array('i', bytes(4 * size))
+        self.duration = array('d', bytes(8 * size))
+        self.n = 0
+
+
+class EventLog:
+    """Logs the triggers, stimuli and responses of the EVT plug-ins as
+    records in preallocated arrays.
+
+    `add()` only stores the record, with the time in ns on the
+    `perf_counter_ns()` clock. The plug-in and the device are stored as
+    small integers, of which the names are looked up once in prepare().
+    When a buffer is full, it is swapped with a spare buffer and written
+    to a CSV file by a background thread. The remaining records are
+    written by `close()`, at the end of the experiment. With a journal,
+    every record is also appended to the journal, which survives a crash.
+    Records can be added from the writer threads as well.
+    """
+
+    def __init__(self, path, size=_BUFFER_SIZE, journal=None):
+        """Initializes the log.
+
+        Parameters
+        ----------
+        path : str
+            The path of the CSV file.
+        size : int, optional
+            The number of records per buffer.
+        journal : Journal, NoneType, optional
+            The journal to which the records are also appended.
+        """
+        self.path = path
+        self._size = size
+        self._buffer = _Buffer(size)
+        self._spare = _Buffer(size)
+        self._pending = None
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._plugins = []
+        self._devices = []
+        self._journal = journal
+        self._lock = threading.Lock()
+        self._fd = open(path, u'w')
+        self._fd.write(_HEADER)
+        self.count = 0 # total number of written records.
+
+    def plugin_id(self, name):
+        """Returns the number under which the events of a plug-in item are
+        logged."""
+        if name not in self._plugins:
+            self._plugins.append(name)
+            if self._journal is not None:
+                self._journal.add_name(u'plugins', name)
+        return self._plugins.index(name)
+
+    def device_id(self, key):
+        """Returns the number under which the events of a device are
+        logged."""
+        if key not in self._devices:
+            self._devices.append(key)
+            if self._journal is not None:
+                self._journal.add_name(u'devices', key)
+        return self._devices.index(key)
+
+    def add(self, plugin, device, kind, value, duration=0, t=None):
+        """Stores an event.
+
+        Parameters
+        ----------
+        plugin : int
+            The number from `plugin_id()`.
+        device : int
+            The number from `device_id()`.
+        kind : int
+            `WRITE`, `PULSE`, `SEQUENCE`, `RESPONSE`, `LED` or `STIMULUS`.
+        value : int
+            The byte value, the response, the pulse value of a stimulus or
+            for the LEDs 1 (set) or 0 (reset).
+        duration : float, optional
+            The pulse duration or the response time in ms.
+        t : int, NoneType, optional
+            The time of the event in ns, or `None` for now.
+        """
+        if t is None:
+            t = perf_counter_ns()
+        with self._lock:
+            buf = self._buffer
+            i = buf.n
+            buf.t[i] = t
+            buf.plugin[i] = plugin
+            buf.device[i] = device
+            buf.kind[i] = kind
+            buf.value[i] = value
+            buf.duration[i] = duration
+            buf.n = i + 1
+            if self._journal is not None:
+                self._journal.append(t, plugin, device, kind, value, duration)
+            if buf.n == self._size:
+                self._swap()
+
+    def _swap(self):
+        if self._pending is not None:
+            self._pending.result() # the spare buffer is still being written.
+        full = self._buffer
+        self._buffer = self._spare
+        self._spare = full
+        self._pending = self._pool.submit(self._write, full)
+
+    def _write(self, buf):
+        plugins = self._plugins
+        devices = self._devices
+        self._fd.write(u''.join(
+            u'{},{},{},{},{},{}\n'.format(
+                buf.t[i], plugins[buf.plugin[i]], devices[buf.device[i]],
+                KIND_NAMES[buf.kind[i]], buf.value[i], buf.duration[i])
+            for i in range(buf.n)))
+        self._fd.flush()
+        self.count += buf.n
+        buf.n = 0
+
+    def close(self):
+        """Writes the remaining records and closes the file."""
+        if self._fd.closed:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.result()
+            self._pool.shutdown()
+            self._write(self._buffer)
+            self._fd.close()
+        oslogger.info('{} EVT events written to: {}'.format(self.count, self.path))
+        if self._journal is not None:
+            self._journal.close()
+
+
+def event_log(experiment):
+    """Returns the event log of the experiment, or `None` when neither the
+    experiment variable `evt_event_log` nor `evt_journal` is set to 'yes'.
+    The log is created on the first call and closed at the end of the
+    experiment. With `evt_journal` set, the log also keeps a journal."""
+    use_journal = experiment.var.get(u'evt_journal', default=u'no') == u'yes'
+    if experiment.var.get(u'evt_event_log', default=u'no') != u'yes' and \
+            not use_journal:
+        return None
+    log = getattr(experiment, u'evt_event_log', None)
+    if log is None:
+        base = os.path.splitext(experiment.logfile or u'subject')[0]
+        journal = Journal(base + _JOURNAL_SUFFIX, KIND_NAMES) if use_journal else None
+        log = EventLog(base + _SUFFIX, journal=journal)
+        experiment.evt_event_log = log
+        experiment.cleanup_functions.append(log.close)
+        oslogger.info('EVT event log: {}'.format(log.path))
+        if journal is not None:
+            oslogger.info('EVT journal: {}'.format(journal.path))
+    return log
+
+
+def text_log(experiment):
+    """Returns whether every event is also logged as text, which is set by
+    the experiment variable `evt_text_log`. This is meant for debugging: the
+    formatting costs time in the run phase."""
+    return experiment.var.get(u'evt_text_log', default=u'no') == u'yes'
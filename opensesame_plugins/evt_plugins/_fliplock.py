@@ -0,0 +1,62 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+from openexp.canvas import Canvas
+
+# global var
+_armed = [] # callbacks that are called after the next display flip.
+
+
+def install_flip_hook(experiment):
+    """Wraps the `show()` method of the canvas back-end of the experiment,
+    so that the armed callbacks are called directly after the flip. The
+    method is only wrapped once."""
+    cls = type(Canvas(experiment))
+    if getattr(cls.show, '_evt_flip_hook', False):
+        return
+    show = cls.show
+
+    @functools.wraps(show)
+    def show_and_fire(self, *args, **kwargs):
+        t_flip = show(self, *args, **kwargs)
+        if _armed:
+            callbacks = list(_armed)
+            del _armed[:]
+            for callback in callbacks:
+                callback(t_flip)
+        return t_flip
+
+    show_and_fire._evt_flip_hook = True
+    cls.show = show_and_fire
+    oslogger.info('Flip hook installed on: {}'.format(cls.__name__))
+
+
+def arm(callback):
+    """Calls `callback` once, with the timestamp of the flip as argument,
+    after the next call of `show()` on any canvas."""
+    _armed.append(callback)
+
+
+def disarm(callback):
+    """Removes an armed callback that has not been called yet."""
+    while callback in _armed:
+        _armed.remove(callback)
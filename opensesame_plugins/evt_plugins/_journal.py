@@ -0,0 +1,183 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+
+The journal can be read back outside OpenSesame, e.g. after a crash:
+
+    python -m opensesame_plugins.evt_plugins._journal journal.bin [out.csv]
+
+For that reason, this module does not import from OpenSesame.
+"""
+
+import json
+import mmap
+import struct
+import sys
+
+# constant
+_MAGIC = b'EVTJRNL1'
+_HEADER = struct.Struct('<8sIIQI') # magic, record size, header size, count at close, names size
+_HEADER_SIZE = 65536 # the header also holds the names of the items and devices.
+_RECORD = struct.Struct('<IIqHHB3xid4x') # magic, seq, t_ns, plugin, device, kind, value, duration
+_RECORD_MAGIC = 0x31545645 # 'EVT1'
+_CHUNK = 262144 # number of records by which the file grows.
+
+
+class Journal:
+    """Appends fixed-size event records to a memory-mapped file.
+
+    A record is written into the mapping with a single `pack_into()`, so
+    appending an event does not need a system call. The pages are written
+    to disk by the operating system, also when OpenSesame crashes. Every
+    record carries a marker and its sequence number, by which the reader
+    finds the end of the valid records in a journal that was not closed.
+    The file is extended in chunks, which is the only moment the mapping
+    is renewed.
+    """
+
+    def __init__(self, path, kinds, capacity=_CHUNK):
+        """Creates the journal file.
+
+        Parameters
+        ----------
+        path : str
+            The path of the journal file.
+        kinds : list
+            The names of the event kinds, stored in the header.
+        capacity : int, optional
+            The initial number of records.
+        """
+        self.path = path
+        self._capacity = capacity
+        self._names = {u'kinds': list(kinds), u'plugins': [], u'devices': []}
+        self._fd = open(path, 'w+b')
+        self._fd.truncate(_HEADER_SIZE + capacity * _RECORD.size)
+        self._map = mmap.mmap(self._fd.fileno(), 0)
+        self.count = 0 # number of appended records.
+        self._write_header()
+
+    def _write_header(self, count=0):
+        names = json.dumps(self._names).encode('utf-8')
+        if _HEADER.size + len(names) > _HEADER_SIZE:
+            raise ValueError(u'Too many names for the journal header')
+        _HEADER.pack_into(self._map, 0, _MAGIC, _RECORD.size, _HEADER_SIZE,
+                          count, len(names))
+        self._map[_HEADER.size:_HEADER.size + len(names)] = names
+
+    def add_name(self, table, name):
+        """Adds the name of a plug-in item or a device to the header.
+
+        Parameters
+        ----------
+        table : str
+            u'plugins' or u'devices'.
+        name : str
+            The name, which gets the next number in the table.
+        """
+        self._names[table].append(name)
+        self._write_header()
+
+    def append(self, t, plugin, device, kind, value, duration):
+        """Appends a record. The arguments are those of
+        `EventLog.add()`, with the time in ns."""
+        if self.count == self._capacity:
+            self._grow()
+        _RECORD.pack_into(self._map, _HEADER_SIZE + self.count * _RECORD.size,
+                          _RECORD_MAGIC, self.count + 1, t, plugin, device,
+                          kind, value, duration)
+        self.count += 1
+
+    def _grow(self):
+        self._map.flush()
+        self._map.close()
+        self._capacity += _CHUNK
+        self._fd.truncate(_HEADER_SIZE + self._capacity * _RECORD.size)
+        self._map = mmap.mmap(self._fd.fileno(), 0)
+
+    def close(self):
+        """Stores the number of records, flushes the mapping and truncates
+        the file to the written records."""
+        if self._fd.closed:
+            return
+        self._write_header(self.count)
+        self._map.flush()
+        self._map.close()
+        self._fd.truncate(_HEADER_SIZE + self.count * _RECORD.size)
+        self._fd.close()
+
+
+def read_journal(path):
+    """Reads the valid records of a journal, also when it was not closed.
+
+    Parameters
+    ----------
+    path : str
+        The path of the journal file.
+
+    Returns
+    -------
+    tuple
+        A (names, records, closed) tuple. `names` is a dict with the
+        lists u'kinds', u'plugins' and u'devices', `records` a list of
+        (t_ns, plugin, device, kind, value, duration) tuples and `closed`
+        tells whether the journal was closed at the end of the experiment.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    if len(data) < _HEADER.size:
+        raise ValueError(u'Not an EVT journal: {}'.format(path))
+    magic, record_size, header_size, count, names_size = _HEADER.unpack_from(data)
+    if magic != _MAGIC or record_size != _RECORD.size:
+        raise ValueError(u'Not an EVT journal: {}'.format(path))
+    names = json.loads(data[_HEADER.size:_HEADER.size + names_size].decode('utf-8'))
+    records = []
+    offset = header_size
+    while offset + record_size <= len(data):
+        record = _RECORD.unpack_from(data, offset)
+        if record[0] != _RECORD_MAGIC or record[1] != len(records) + 1:
+            break
+        records.append(record[2:])
+        offset += record_size
+    return names, records, count == len(records) and count > 0
+
+
+def _name(table, i):
+    return table[i] if i < len(table) else i
+
+
+def main(argv):
+    if len(argv) not in (1, 2):
+        print(u'usage: python -m opensesame_plugins.evt_plugins._journal '
+              u'journal [output.csv]', file=sys.stderr)
+        return 2
+    names, records, closed = read_journal(argv[0])
+    out = open(argv[1], 'w') if len(argv) == 2 else sys.stdout
+    out.write(u't_ns,plugin,device,kind,value,duration\n')
+    for t, plugin, device, kind, value, duration in records:
+        out.write(u'{},{},{},{},{},{}\n'.format(
+            t, _name(names[u'plugins'], plugin), _name(names[u'devices'], device),
+            _name(names[u'kinds'], kind), value, duration))
+    if out is not sys.stdout:
+        out.close()
+    print(u'{} records recovered{}'.format(
+        len(records), u'' if closed else u', the journal was not closed'),
+        file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,187 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+from array import array
+from math import log10
+from time import perf_counter_ns
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+
+# constant
+_PER_DECADE = 100 # buckets per decade, a bucket is about 2.3% wide.
+_DECADES = 11 # from 1 ns to 100 s.
+_N_BUCKETS = _PER_DECADE * _DECADES
+OPERATIONS = (u'write_lines', u'pulse_lines', u'set_led_rgb', u'wait_for_event')
+
+
+class LatencyHistogram:
+    """Counts durations in ns in logarithmic buckets of fixed size.
+
+    The buckets are preallocated, so adding a duration does not allocate.
+    The minimum and maximum are exact, the percentiles are accurate to the
+    width of a bucket.
+    """
+
+    def __init__(self):
+        self.buckets = array('Q', bytes(8 * _N_BUCKETS))
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, ns):
+        """Counts a duration in ns."""
+        i = int(_PER_DECADE * log10(ns)) if ns > 1 else 0
+        self.buckets[i if i < _N_BUCKETS else _N_BUCKETS - 1] += 1
+        self.count += 1
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if self.max is None or ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        """Returns the p-th percentile [0-100] in ns, or `None` if the
+        histogram is empty."""
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        total = 0
+        for i, n in enumerate(self.buckets):
+            total += n
+            if total >= rank and n > 0:
+                ns = 10 ** ((i + 0.5) / _PER_DECADE) # middle of the bucket
+                return min(max(ns, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """Returns the (min, median, p99, max) tuple in ms."""
+        return tuple(None if ns is None else ns / 1000000 for ns in
+                     (self.min, self.percentile(50), self.percentile(99),
+                      self.max))
+
+
+class InstrumentedDevice:
+    """Wraps an EventExchanger handle and measures the duration of the
+    device calls of the plug-ins. All other attributes are passed on to the
+    handle."""
+
+    def __init__(self, handle, histograms):
+        """Initializes the wrapper.
+
+        Parameters
+        ----------
+        handle : EventExchanger
+            An attached EventExchanger handle.
+        histograms : dict
+            A dict with a `LatencyHistogram` for every operation.
+        """
+        self.handle = handle
+        self._write_lines = histograms[u'write_lines'].add
+        self._pulse_lines = histograms[u'pulse_lines'].add
+        self._set_led_rgb = histograms[u'set_led_rgb'].add
+        self._wait_for_event = histograms[u'wait_for_event'].add
+
+    def write_lines(self, *args, **kwargs):
+        t0 = perf_counter_ns()
+        result = self.handle.write_lines(*args, **kwargs)
+        self._write_lines(perf_counter_ns() - t0)
+        return result
+
+    def pulse_lines(self, *args, **kwargs):
+        t0 = perf_counter_ns()
+        result = self.handle.pulse_lines(*args, **kwargs)
+        self._pulse_lines(perf_counter_ns() - t0)
+        return result
+
+    def set_led_rgb(self, *args, **kwargs):
+        t0 = perf_counter_ns()
+        result = self.handle.set_led_rgb(*args, **kwargs)
+        self._set_led_rgb(perf_counter_ns() - t0)
+        return result
+
+    def wait_for_event(self, *args, **kwargs):
+        t0 = perf_counter_ns()
+        result = self.handle.wait_for_event(*args, **kwargs)
+        self._wait_for_event(perf_counter_ns() - t0)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+    def __str__(self):
+        return str(self.handle)
+
+
+def device_histograms():
+    """Returns a dict with an empty `LatencyHistogram` for every
+    operation."""
+    return {op: LatencyHistogram() for op in OPERATIONS}
+
+
+def _tag(key):
+    """Returns the device key as part of a variable name, e.g.
+    EVT2_s_n_0000."""
+    return re.sub(r'\W+', u'_', key[15:]).strip(u'_')
+
+
+def publish_latencies(experiment, histograms):
+    """Stores the min, median, p99 and max in ms of every device and
+    operation as experiment variables, named
+    `evt_latency_[device]_[operation]_[statistic]`.
+
+    Parameters
+    ----------
+    experiment : Experiment
+        The experiment.
+    histograms : dict
+        The histograms per operation, per device key.
+    """
+    for key, device in histograms.items():
+        tag = _tag(key)
+        for op, histogram in device.items():
+            if histogram.count == 0:
+                continue
+            for stat, value in zip((u'min', u'median', u'p99', u'max'),
+                                   histogram.summary()):
+                experiment.var.set(u'evt_latency_{}_{}_{}'.format(tag, op, stat), value)
+
+
+def write_latencies(path, histograms):
+    """Writes the number of calls and the min, median, p99 and max in ms of
+    every device and operation to a CSV file, and logs them.
+
+    Parameters
+    ----------
+    path : str
+        The path of the CSV file.
+    histograms : dict
+        The histograms per operation, per device key.
+    """
+    with open(path, u'w') as fd:
+        fd.write(u'device,operation,count,min,median,p99,max\n')
+        for key, device in histograms.items():
+            for op, histogram in device.items():
+                if histogram.count == 0:
+                    continue
+                summary = histogram.summary()
+                fd.write(u'{},{},{},{},{},{},{}\n'.format(
+                    key, op, histogram.count, *summary))
+                oslogger.info('{} {}: {} calls, min {:.3f}, median {:.3f}, p99 {:.3f}, max {:.3f} ms'.format(
+                    key, op, histogram.count, *summary))
+    oslogger.info('EVT device latencies written to: {}'.format(path))
@@ -0,0 +1,111 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from qtpy.QtCore import QObject, Signal, Slot
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+from ._devices import scan_devices
+
+# constant
+_TTL = 5.0 # seconds that a scan result is shared among the plug-in editors.
+
+# global var
+_executor = ThreadPoolExecutor(max_workers=1)
+_notifier = None
+_scanning = False
+_last_scan = None # (time of the scan, device list)
+_callbacks = [] # (device group, callback) waiting for the running scan.
+
+
+class _ScanNotifier(QObject):
+    """Passes the scan result from the worker thread to the GUI thread.
+
+    The notifier is created in the GUI thread, so the signal that the worker
+    emits is queued to the slot of the notifier, which runs in the GUI
+    thread.
+    """
+    scan_done = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.scan_done.connect(self.deliver)
+
+    @Slot(object)
+    def deliver(self, device_list):
+        _deliver(device_list)
+
+
+def _scan_worker():
+    try:
+        device_list = scan_devices()
+    except Exception as e:
+        oslogger.warning('Scanning for EVT devices failed: {}'.format(e))
+        device_list = []
+    _notifier.scan_done.emit(device_list)
+
+
+def _deliver(device_list):
+    """Runs in the GUI thread when the worker has finished scanning."""
+    global _scanning, _last_scan
+    _scanning = False
+    _last_scan = (monotonic(), device_list)
+    callbacks = list(_callbacks)
+    del _callbacks[:]
+    for device_group, callback in callbacks:
+        _call(callback, device_group, device_list)
+
+
+def _call(callback, device_group, device_list):
+    try:
+        callback([d for d in device_list
+                  if device_group.lower() in d['product_string'].lower()])
+    except RuntimeError:
+        pass # the editor widget has been deleted in the mean time.
+
+
+def request_devices(device_group, callback, refresh=False):
+    """Scans for EVT devices in a background thread, so that the editor
+    does not freeze while scanning.
+
+    Must be called from the GUI thread. The callback is also called in the
+    GUI thread. A scan result that is less than a few seconds old is shared
+    by all plug-in editors, and concurrent requests share one scan.
+
+    Parameters
+    ----------
+    device_group : str
+        The device group to filter on, e.g. u'EVT' or u'RSP'.
+    callback : callable
+        Called with the filtered device list as argument.
+    refresh : bool, optional
+        Ignore a recent scan result and scan again.
+    """
+    global _notifier, _scanning
+    if _notifier is None:
+        _notifier = _ScanNotifier()
+    if not refresh and not _scanning and _last_scan is not None and \
+            monotonic() - _last_scan[0] < _TTL:
+        _call(callback, device_group, _last_scan[1])
+        return
+    _callbacks.append((device_group, callback))
+    if not _scanning:
+        _scanning = True
+        _executor.submit(_scan_worker)
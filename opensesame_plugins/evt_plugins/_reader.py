@@ -0,0 +1,333 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from array import array
+from time import perf_counter_ns
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+
+# constant
+_RING_SIZE = 4096 # number of records in the ring buffer.
+_READ_TIMEOUT = 10 # ms, max. time a HID read blocks before checking for stop.
+_EDGE_SIZE = 8192 # max. number of edges that are recorded in a response window.
+
+# edge types
+RELEASE = 0
+PRESS = 1
+
+
+class EventReader(threading.Thread):
+    """Drains an RSP device in a background thread.
+
+    Every input report is stored in a preallocated ring buffer as a
+    (button mask, timestamp) record. The timestamp is taken with
+    `perf_counter_ns()` directly after the report is read. When the thread
+    ends, e.g. because the device was unplugged or closed, the reader is
+    marked as closed and the waits return as on a timeout.
+    """
+
+    def __init__(self, handle, size=_RING_SIZE):
+        """Initializes the reader.
+
+        Parameters
+        ----------
+        handle : EventExchanger
+            An attached EventExchanger handle.
+        size : int, optional
+            The number of records in the ring buffer.
+        """
+        super().__init__(daemon=True)
+        self._device = handle.device
+        self._size = size
+        self._mask = array('B', bytes(size))
+        self._time = array('q', bytes(8 * size))
+        self._cond = threading.Condition()
+        self._running = True
+        self.closed = False # the thread has ended, no records will follow.
+        self._listeners = [] # (queue, tag) pairs that get a copy of every record.
+        self.count = 0 # total number of records that were written.
+
+    def run(self):
+        try:
+            self._read()
+        finally:
+            with self._cond:
+                self.closed = True
+                self._cond.notify_all()
+            for queue, tag in self._listeners:
+                queue.put((tag, -1, None)) # the device is gone.
+
+    def _read(self):
+        read = self._device.read
+        mask = self._mask
+        timestamps = self._time
+        size = self._size
+        while self._running:
+            try:
+                data = read(1, _READ_TIMEOUT)
+            except (IOError, OSError, ValueError) as e:
+                oslogger.warning('Reading from the RSP device failed: {}'.format(e))
+                break
+            if not data:
+                continue
+            t = perf_counter_ns()
+            i = self.count % size
+            mask[i] = data[0]
+            timestamps[i] = t
+            with self._cond:
+                self.count += 1
+                self._cond.notify_all()
+            for queue, tag in self._listeners:
+                queue.put((tag, data[0], t))
+
+    def add_listener(self, queue, tag):
+        """Puts a (tag, button mask, timestamp) tuple of every new record on
+        `queue`. This way a single queue can wait on several readers. When
+        the reader ends, (tag, -1, None) is put on the queue."""
+        if (queue, tag) not in self._listeners:
+            self._listeners = self._listeners + [(queue, tag)]
+
+    def stop(self):
+        """Stops the reader thread and waits until it has finished."""
+        self._running = False
+        if self.is_alive():
+            self.join()
+
+    def record(self, n):
+        """Returns record number `n` as a (button mask, timestamp) tuple."""
+        i = n % self._size
+        return self._mask[i], self._time[i]
+
+    def first_index(self, t_start):
+        """Returns the number of the first record that is still available
+        in the ring buffer and was read at or after `t_start` (ns)."""
+        n = max(self.count - self._size, 0)
+        count = self.count
+        timestamps = self._time
+        size = self._size
+        while n < count and timestamps[n % size] < t_start:
+            n += 1
+        return n
+
+    def poll(self, allowed_event_lines, n):
+        """Checks the records from record number `n` on for an allowed event,
+        without blocking.
+
+        Returns
+        -------
+        tuple
+            A (button mask, timestamp in ns, next record number) tuple. The
+            button mask is -1 and the timestamp `None` if there is no allowed
+            event yet.
+        """
+        count = self.count
+        while n < count:
+            mask, t = self.record(n)
+            n += 1
+            if mask & allowed_event_lines:
+                return mask, t, n
+        return -1, None, n
+
+    def wait_for_records(self, n, deadline):
+        """Waits until there are more than `n` records or until `deadline`
+        (ns) has passed.
+
+        Returns
+        -------
+        bool
+            `True` if there are new records, `False` on timeout or when
+            the reader has ended.
+        """
+        with self._cond:
+            while self.count <= n:
+                if self.closed:
+                    return False
+                remaining = deadline - perf_counter_ns()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining / 1e9)
+            return True
+
+    def wait_for_event(self, allowed_event_lines, t_start, timeout_ms=None):
+        """Waits for the first allowed event that was read at or after
+        `t_start`.
+
+        Parameters
+        ----------
+        allowed_event_lines : int
+            Bit mask [0-255] of the allowed buttons.
+        t_start : int
+            The onset in ns on the `perf_counter_ns()` clock.
+        timeout_ms : int, NoneType, optional
+            The timeout, counted from `t_start`, or `None` for no timeout.
+
+        Returns
+        -------
+        tuple
+            A (button mask, timestamp in ns) tuple, or (-1, None) on
+            timeout or when the reader has ended.
+        """
+        deadline = None if timeout_ms is None else t_start + timeout_ms * 1000000
+        n = self.first_index(t_start)
+        with self._cond:
+            while True:
+                while n < self.count:
+                    mask, t = self.record(n)
+                    n += 1
+                    if mask & allowed_event_lines:
+                        return mask, t
+                if self.closed:
+                    return -1, None
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - perf_counter_ns()
+                if remaining <= 0:
+                    return -1, None
+                self._cond.wait(remaining / 1e9)
+
+
+class EdgeRecorder:
+    """Records the button presses and releases from an `EventReader` during
+    a response window.
+
+    The edges are stored in preallocated arrays of button number (1-8),
+    edge type (`PRESS` or `RELEASE`) and timestamp in ns, so recording does
+    not allocate memory per event.
+    """
+
+    def __init__(self, size=_EDGE_SIZE):
+        self.size = size
+        self.button = array('B', bytes(size))
+        self.edge = array('B', bytes(size))
+        self.time = array('q', bytes(8 * size))
+        self.count = 0
+
+    def start(self, reader, allowed_event_lines, t_start):
+        """Starts recording the edges of the allowed buttons from `t_start`
+        (ns) on. The edges are taken from the reader by `poll()`."""
+        self._reader = reader
+        self._allowed = allowed_event_lines
+        self._n = reader.first_index(t_start)
+        # the button state just before the window opened:
+        self._state = reader.record(self._n - 1)[0] & allowed_event_lines \
+            if self._n > 0 else 0
+        self.count = 0
+
+    def poll(self, t_end):
+        """Records the edges in the records that the reader has read so far,
+        without blocking.
+
+        Parameters
+        ----------
+        t_end : int
+            The end of the window in ns.
+
+        Returns
+        -------
+        bool
+            `True` when the window has closed.
+        """
+        reader = self._reader
+        allowed_event_lines = self._allowed
+        button = self.button
+        edge = self.edge
+        timestamps = self.time
+        size = self.size
+        count = self.count
+        state = self._state
+        closed = False
+        while self._n < reader.count:
+            mask, t = reader.record(self._n)
+            self._n += 1
+            if t >= t_end:
+                closed = True
+                break
+            mask &= allowed_event_lines
+            changed = mask ^ state
+            state = mask
+            b = 0
+            while changed:
+                if changed & 1:
+                    if count < size:
+                        button[count] = b + 1
+                        edge[count] = mask >> b & 1
+                        timestamps[count] = t
+                        count += 1
+                        if count == size:
+                            oslogger.warning('Response window full, the last edges were not recorded!')
+                changed >>= 1
+                b += 1
+        self.count = count
+        self._state = state
+        return closed or perf_counter_ns() >= t_end
+
+    def record_window(self, reader, allowed_event_lines, t_start, window_ms):
+        """Records all edges of the allowed buttons from `t_start` (ns) until
+        the window of `window_ms` has passed. Blocks until the window has
+        closed.
+
+        Returns
+        -------
+        int
+            The number of recorded edges.
+        """
+        t_end = t_start + window_ms * 1000000
+        self.start(reader, allowed_event_lines, t_start)
+        while reader.wait_for_records(self._n, t_end):
+            if self.poll(t_end):
+                break
+        return self.count
+
+    def summary(self, t_start):
+        """Pairs the presses with their releases.
+
+        Parameters
+        ----------
+        t_start : int
+            The onset of the window in ns, to which the times are relative.
+
+        Returns
+        -------
+        tuple
+            A (buttons, press times, release times, hold durations) tuple of
+            lists, with the times in ms. The release time and hold duration
+            are -1 for a press that was not released within the window.
+        """
+        buttons = []
+        press_times = []
+        release_times = []
+        hold_durations = []
+        open_press = [-1] * 8 # index of the unreleased press per button
+        for i in range(self.count):
+            b = self.button[i]
+            t = (self.time[i] - t_start) / 1000000
+            if self.edge[i] == PRESS:
+                open_press[b - 1] = len(buttons)
+                buttons.append(b)
+                press_times.append(t)
+                release_times.append(-1)
+                hold_durations.append(-1)
+            elif open_press[b - 1] >= 0:
+                j = open_press[b - 1]
+                release_times[j] = t
+                hold_durations[j] = t - press_times[j]
+                open_press[b - 1] = -1
+        return buttons, press_times, release_times, hold_durations
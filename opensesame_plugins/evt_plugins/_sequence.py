@@ -0,0 +1,129 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+from array import array
+from time import (perf_counter_ns, sleep)
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+
+# constant
+_SPIN_NS = 2000000 # ns before a deadline at which sleeping changes to spinning.
+_THREAD_PRIORITY_TIME_CRITICAL = 15
+
+
+class TriggerSequence:
+    """A trigger sequence, compiled into flat arrays.
+
+    A sequence of n steps has n + 1 entries: the last one restores the
+    output lines when the sequence has finished. The offsets are in ns from
+    the start of the sequence. The measured write times are stored in
+    `times`, in ns from the start of the sequence, so the accuracy of the
+    playback can be checked afterwards.
+    """
+
+    def __init__(self, text):
+        """Compiles a sequence.
+
+        Parameters
+        ----------
+        text : str
+            The steps as 'value,duration;value,duration;...' with the byte
+            value [0-255] and the duration in ms.
+        """
+        steps = []
+        for step in str(text).split(u';'):
+            if not step.strip():
+                continue
+            try:
+                value, duration = step.split(u',')
+                value = int(value)
+                duration = float(duration)
+            except ValueError:
+                raise ValueError(u'Invalid trigger sequence step: {}'.format(step))
+            if not 0 <= value <= 255 or duration <= 0:
+                raise ValueError(u'Invalid trigger sequence step: {}'.format(step))
+            steps.append((value, duration))
+        if not steps:
+            raise ValueError(u'The trigger sequence is empty')
+        self.values = array('B', [value for value, duration in steps] + [0])
+        self.offsets = array('q', bytes(8 * (len(steps) + 1)))
+        t = 0
+        for i, (value, duration) in enumerate(steps):
+            self.offsets[i] = int(t)
+            t += duration * 1000000
+        self.offsets[len(steps)] = int(t)
+        self.times = array('q', bytes(8 * (len(steps) + 1)))
+
+    def __len__(self):
+        return len(self.values) - 1
+
+    def step_times(self):
+        """Returns the measured write times in ms from the start."""
+        return [t / 1000000 for t in self.times]
+
+    def max_error(self):
+        """Returns the largest deviation of a write from its deadline in
+        ms."""
+        return max(abs(t - offset) for t, offset in zip(self.times, self.offsets)) / 1000000
+
+
+def raise_thread_priority():
+    """Raises the priority of the calling thread, where the platform allows
+    it. This is best effort: a failure is only logged."""
+    if sys.platform != 'win32':
+        return
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetThreadPriority(kernel32.GetCurrentThread(),
+                                   _THREAD_PRIORITY_TIME_CRITICAL)
+    except (ImportError, AttributeError, OSError) as e:
+        oslogger.warning('Could not raise the thread priority: {}'.format(e))
+
+
+def play_sequence(handle, sequence, restore_value):
+    """Plays a sequence on a device, with every write scheduled at an
+    absolute deadline from the start. The thread sleeps until shortly
+    before each deadline and then spins.
+
+    Parameters
+    ----------
+    handle : EventExchanger
+        An attached EventExchanger handle.
+    sequence : TriggerSequence
+        The compiled sequence.
+    restore_value : int
+        The value that the output lines get after the sequence.
+    """
+    values = sequence.values
+    offsets = sequence.offsets
+    times = sequence.times
+    write_lines = handle.write_lines
+    values[len(values) - 1] = restore_value
+    t0 = perf_counter_ns()
+    for i in range(len(values)):
+        deadline = t0 + offsets[i]
+        remaining = deadline - perf_counter_ns()
+        if remaining > _SPIN_NS:
+            sleep((remaining - _SPIN_NS) / 1e9)
+        while perf_counter_ns() < deadline:
+            pass
+        write_lines(values[i])
+        times[i] = perf_counter_ns() - t0
@@ -0,0 +1,193 @@
+#-*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This plug-in is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from array import array
+from collections import deque
+from time import perf_counter_ns
+from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+from ._sequence import (play_sequence, raise_thread_priority)
+
+# constant
+_RECORD_SIZE = 4096 # number of writes of which the times are kept.
+
+# write operations
+WRITE = 0
+PULSE = 1
+SEQUENCE = 2
+
+
+class TriggerWriter(threading.Thread):
+    """Performs the writes to an EVT device in a background thread.
+
+    `submit()` only appends the write to a queue and returns, so the USB
+    transfer and the logging are done outside the timing-critical item. For
+    every write, the time of the request and the time at which the transfer
+    completed are kept in a preallocated ring buffer, in ns on the
+    `perf_counter_ns()` clock. Every write is only logged as text when
+    `verbose` is set. Should the thread end unexpectedly, the writer is
+    marked as closed and `drain()` no longer waits for it.
+    """
+
+    def __init__(self, handle, size=_RECORD_SIZE):
+        """Initializes the writer.
+
+        Parameters
+        ----------
+        handle : EventExchanger
+            An attached EventExchanger handle.
+        size : int, optional
+            The number of writes of which the times are kept.
+        """
+        super().__init__(daemon=True)
+        self._handle = handle
+        self._size = size
+        self._jobs = deque() # append() and popleft() are thread-safe.
+        self._wakeup = threading.Event()
+        self._done = threading.Condition()
+        self._running = True
+        self.closed = False # the thread has ended, no writes will follow.
+        self._priority_raised = False
+        self.request_time = array('q', bytes(8 * size))
+        self.complete_time = array('q', bytes(8 * size))
+        self.submitted = 0 # total number of submitted writes.
+        self.count = 0 # total number of completed writes.
+        self.verbose = False # log every write as text.
+
+    def submit(self, op, value, duration=0, done=None):
+        """Queues a write.
+
+        Parameters
+        ----------
+        op : int
+            `WRITE` to write the output lines, `PULSE` to pulse them or
+            `SEQUENCE` to play a sequence.
+        value : int, TriggerSequence
+            The byte value [0-255], or the compiled sequence.
+        duration : int, optional
+            The pulse duration in ms, or for a sequence the value that the
+            output lines get after the sequence.
+        done : callable, NoneType, optional
+            Called in the writer thread when the write has completed, with
+            `value`, the request time and the completion time in ns as
+            arguments.
+
+        Returns
+        -------
+        int
+            The sequence number of the write.
+        """
+        seq = self.submitted
+        self.submitted += 1
+        self._jobs.append((seq, op, value, duration, done, perf_counter_ns()))
+        self._wakeup.set()
+        return seq
+
+    def replace_handle(self, handle):
+        """Replaces the device handle, e.g. by a wrapper that measures the
+        calls. The writes from the next one on use the new handle."""
+        self._handle = handle
+
+    def run(self):
+        try:
+            self._write()
+        finally:
+            with self._done:
+                self.closed = True
+                self._done.notify_all()
+
+    def _write(self):
+        jobs = self._jobs
+        size = self._size
+        while True:
+            if not jobs:
+                if not self._running:
+                    break
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            seq, op, value, duration, done, t_request = jobs.popleft()
+            handle = self._handle
+            try:
+                if op == PULSE:
+                    handle.pulse_lines(value, duration)
+                elif op == SEQUENCE:
+                    if not self._priority_raised:
+                        raise_thread_priority()
+                        self._priority_raised = True
+                    play_sequence(handle, value, duration)
+                else:
+                    handle.write_lines(value)
+            except Exception as e:
+                oslogger.warning('Writing to the EVT device failed: {}'.format(e))
+            t_complete = perf_counter_ns()
+            i = seq % size
+            self.request_time[i] = t_request
+            self.complete_time[i] = t_complete
+            if done is not None:
+                try:
+                    done(value, t_request, t_complete)
+                except Exception as e:
+                    oslogger.warning('Handling the completed write failed: {}'.format(e))
+            with self._done:
+                self.count = seq + 1
+                self._done.notify_all()
+            if not self.verbose:
+                continue
+            if op == SEQUENCE:
+                oslogger.info('{}: played a sequence of {} steps, max. deviation {:.3f} ms'.format(
+                    handle, len(value), value.max_error()))
+            elif op == PULSE:
+                oslogger.info('{}: send byte code {} for the duration of {} ms, completed in {:.3f} ms'.format(
+                    handle, value, duration, (t_complete - t_request) / 1000000))
+            else:
+                oslogger.info('{}: send byte code {}, completed in {:.3f} ms'.format(
+                    handle, value, (t_complete - t_request) / 1000000))
+
+    def record(self, seq):
+        """Returns the (request time, completion time) tuple in ns of write
+        `seq`, or `None` if it has not completed yet or is no longer in the
+        ring buffer."""
+        if seq >= self.count or seq < self.count - self._size:
+            return None
+        i = seq % self._size
+        return self.request_time[i], self.complete_time[i]
+
+    def drain(self, timeout=None):
+        """Waits until all submitted writes have completed.
+
+        Returns
+        -------
+        bool
+            `False` if the timeout (s) passed first, or if the writer thread
+            has ended before completing the writes.
+        """
+        with self._done:
+            self._done.wait_for(
+                lambda: self.count >= self.submitted or self.closed, timeout)
+            return self.count >= self.submitted
+
+    def stop(self):
+        """Completes the queued writes, stops the writer thread and waits
+        until it has finished."""
+        self._running = False
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
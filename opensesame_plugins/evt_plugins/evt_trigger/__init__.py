@@ -27,7 +27,8 @@ controls = [
             "Clear output lines",
             "Write output lines",
             "Invert output lines",
-            "Pulse output lines"
+            "Pulse output lines",
+            "Sequence output lines"
         ],
         "name": "output_mode_combobox_widget",
         "tooltip": "Select the desired output mode"
@@ -91,6 +92,30 @@ controls = [
         "label": "Duration [ms] :",
         "name": "duration_line_edit_widget",
         "tooltip": "Expecting a value in milliseconds"
+    }, {
+        "type": "line_edit",
+        "var": "sequence",
+        "label": "Sequence [value,ms;...] :",
+        "name": "sequence_line_edit_widget",
+        "tooltip": "Expecting value,duration steps separated by semicolons, e.g. 1,10;2,10;4,10"
+    }, {
+        "type": "checkbox",
+        "var": "async_write",
+        "label": "Write in the background",
+        "name": "async_write_checkbox_widget",
+        "tooltip": "Queue the write and return immediately. A background thread does the USB transfer and logs the completion time."
+    }, {
+        "type": "checkbox",
+        "var": "on_flip",
+        "label": "Send on the next display flip",
+        "name": "on_flip_checkbox_widget",
+        "tooltip": "Send the trigger directly after the next canvas (e.g. sketchpad) is shown. Place this item before the sketchpad."
+    }, {
+        "type": "checkbox",
+        "var": "coalesce_writes",
+        "label": "Skip writes that do not change the output lines",
+        "name": "coalesce_writes_checkbox_widget",
+        "tooltip": "Do not send a write when the output lines already have the value. The number of skipped writes is stored in skipped_writes_[item name]."
     }, {
         "type": "checkbox",
         "var": "close_device",
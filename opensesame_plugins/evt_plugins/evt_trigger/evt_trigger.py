@@ -17,26 +17,33 @@ You should have received a copy of the GNU General Public License
 along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import functools
+from time import perf_counter_ns
 from libopensesame.py3compat import *
 from libopensesame.item import Item
 from libqtopensesame.items.qtautoplugin import QtAutoPlugin
 from libopensesame.oslogging import oslogger
-from time import sleep
-from pyevt import EventExchanger # pyevt 2.0
+from .._devices import (open_devices, find_device, close_devices, trigger_writer,
+    stop_writers, instrument_devices)
+from .._writer import (WRITE, PULSE, SEQUENCE)
+from .._sequence import TriggerSequence
+from .._fliplock import (install_flip_hook, arm, disarm)
+from .._eventlog import (event_log, text_log)
+from .._qtscan import request_devices
 
 # constant
 _DEVICE_GROUP = u'EVT'
 
 # global var
-open_devices = {} # store open device handles.
 device_output_value = {} # store output state of connected devices.
+device_line_value = {} # last value written to the output lines, None if unknown.
+skipped_writes = {} # number of coalesced writes per item.
 
 class EvtTrigger(Item):
 
     description = u"A plug-in for generating triggers with EVT devices."
 
-    global open_devices
-    global device_output_value
+    global device_output_value, device_line_value, skipped_writes
 
     # Reset plug-in to initial values.
     def reset(self):
@@ -54,6 +61,10 @@ class EvtTrigger(Item):
         self.var.bit7 = 'no'
         self.var.mask = 0
         self.var.duration = 1000
+        self.var.sequence = u'1,10;2,10;4,10'
+        self.var.async_write = 'no'
+        self.var.on_flip = 'no'
+        self.var.coalesce_writes = 'no'
         self.var.close_device = 'no'
 
     def prepare(self):
@@ -62,96 +73,263 @@ class EvtTrigger(Item):
 
         self.output_value = 0 # create output state storage for dummy mode.
 
+        # A trigger that was armed in the previous run, but not sent, is dropped.
+        disarm(self.write_on_flip)
+        if self.var.on_flip == 'yes':
+            install_flip_hook(self.experiment)
+            self.experiment.var.set(u'trigger_flip_delay_' + self.name, None)
+
+        # compile the trigger sequence:
+        self.sequence = None
+        if self.var.outputmode == u'Sequence output lines':
+            self.sequence = TriggerSequence(self.var.sequence)
+            self.experiment.var.set(u'sequence_step_times_' + self.name, None)
+            self.experiment.var.set(u'sequence_max_error_' + self.name, None)
+
+        instrument_devices(self.experiment) # measure the device calls, if enabled.
+        # searching for selected device:
+        self.current_device = None
+        self.writer = None
+        self.other_writer = None
         if self.var.device == u'DUMMY':
             oslogger.warning("Hardware configuration could have changed! Dummy prepare...")
-        elif len(open_devices) == 0:
-            # Create a shadow device list to find 'path' from the current selected device.
-            # 'path' is an unique device ID.
-            temp_evt = EventExchanger()
-            sleep(1) # without a delay, the list will not always be complete.
+        else:
             try:
-                device_list = temp_evt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-                del temp_evt
-                # oslogger.info("device list: {}".format(device_list))
-                for d in device_list:
-                    sleep(1) # without a delays, the device will not always be there.
-                    composed_string = d['product_string'] + " s/n: " + d['serial_number']
-                    open_devices[composed_string] = EventExchanger()
-                    device_output_value[composed_string] = 0 # create device output state storage
-                    # Get evt device handle:
-                    open_devices[composed_string].attach_id(d['path'])
-                    oslogger.info('Device successfully attached as: {} s/n: {}'.format(
-                        d['product_string'], d['serial_number']))
-                    oslogger.info('        ...  and with device ID: {}'.format(
-                        open_devices[composed_string]))
+                self.current_device = find_device(_DEVICE_GROUP, self.var.device)
             except:
                 oslogger.warning("Connecting EVT-device failed! Device set to dummy.")
                 self.var.device = u'DUMMY'
-
-        # searching for selected device:
-        self.current_device = None
-        for dkey in open_devices:
-            if self.var.device[:15] in dkey:
-                self.current_device = dkey # assign to value that belongs to the key.
         if self.current_device is None:
             oslogger.warning("EVT-device not found! Device set to dummy.")
             self.var.device = u'DUMMY'
         else:
+            # create device output state storage
+            device_output_value.setdefault(self.current_device, 0)
             oslogger.info('Preparing device: {}'.format(open_devices[self.current_device]))
-            open_devices[self.current_device].write_lines(0) # clear lines
+            # sequences are always played by the writer thread.
+            if self.var.async_write == 'yes' or self.sequence is not None:
+                self.writer = trigger_writer(self.current_device)
+                if stop_writers not in self.experiment.cleanup_functions:
+                    # before the event log, to which the writes are logged, is closed.
+                    self.experiment.cleanup_functions.insert(0, stop_writers)
+                self.writer.verbose = text_log(self.experiment)
+                self.experiment.var.set(u'trigger_write_time_' + self.name, None)
+                self.experiment.var.set(u'trigger_write_delay_' + self.name, None)
+                self.writer.submit(WRITE, 0) # clear lines
+                device_line_value[self.current_device] = 0
+            else:
+                # don't write while another item's writes are still queued.
+                self.other_writer = trigger_writer(self.current_device, start=False)
+                if self.other_writer is not None:
+                    self.other_writer.drain()
+                open_devices[self.current_device].write_lines(0) # clear lines
+                device_line_value[self.current_device] = 0
+
+        if self.var.coalesce_writes == 'yes':
+            skipped_writes.setdefault(self.name, 0)
+            self.experiment.var.set(u'skipped_writes_' + self.name,
+                                    skipped_writes[self.name])
 
         # pass device var to experiment as global:
         var_name = "self.experiment.var.connected_device_" + self.name
         exec(f'{var_name} = "{self.var.device}"')
 
+        # resolve everything that run() needs:
+        self.send = self.compile_send()
+        self.send_on_flip = self.var.on_flip == 'yes'
+        self.close_after_send = self.var.close_device == 'yes'
+        self.text_log = text_log(self.experiment)
+
     def run(self):
         """The run phase of the plug-in goes here."""
         self.set_item_onset()
+        if self.send_on_flip:
+            # The trigger is sent by the flip hook, directly after the next
+            # canvas is shown.
+            arm(self.write_on_flip)
+            return
+        self.send()
+        # close the device?
+        if self.close_after_send:
+            close_devices([self.current_device])
+
+    def write_on_flip(self, t_flip):
+        """Sends the trigger and logs the delay from the flip."""
+        self.send()
+        delay = self.clock.time() - t_flip
+        self.experiment.var.set(u'trigger_flip_delay_' + self.name, delay)
+        if self.text_log:
+            oslogger.info('{}: trigger sent {:.3f} ms after the flip'.format(self.name, delay))
+        # close the device?
+        if self.close_after_send:
+            close_devices([self.current_device])
+
+    def compile_send(self):
+        """Resolves the output mode, the device handle and the mask into a
+        single callable that sends the trigger, so that run() only has to
+        call it."""
         if self.var.device == u'DUMMY':
-            if self.var.outputmode == u'Clear output lines':
-                self.output_value = 0
-                oslogger.info('dummy: send byte code {}'.format(self.output_value))
-            elif self.var.outputmode == u'Write output lines':
-                self.output_value = self.var.mask
-                oslogger.info('dummy: send byte code {}'.format(self.output_value))
-            elif self.var.outputmode == u'Invert output lines':
-                self.output_value ^= self.var.mask
-                oslogger.info('dummy: send byte code {}'.format(self.output_value))
-            elif self.var.outputmode == u'Pulse output lines':
-                oslogger.info('dummy: send byte code {} for the duration of {} ms'.format(
-                self.output_value ^ self.var.mask, self.var.duration))
+            return self.send_dummy
+        mode = self.var.outputmode
+        mask = self.var.mask
+        duration = self.var.duration
+        key = self.current_device
+        state = device_output_value # Store output state as global. (There is no read-back from the hardware.)
+        lines = device_line_value
+        if self.sequence is not None:
+            submit = self.writer.submit
+            sequence = self.sequence
+            done = self.compile_done(SEQUENCE)
+            def send():
+                lines[key] = state[key] # the sequence ends with the output state.
+                submit(SEQUENCE, sequence, state[key], done=done)
+        else:
+            if self.writer is not None:
+                # the writer thread does the transfer.
+                kind = PULSE if mode == u'Pulse output lines' else WRITE
+                done = self.compile_done(kind)
+                write_lines = functools.partial(self.writer.submit, WRITE, done=done)
+                pulse_lines = functools.partial(self.writer.submit, PULSE, done=done)
+            else:
+                write_lines = open_devices[key].write_lines
+                pulse_lines = open_devices[key].pulse_lines
+                log = event_log(self.experiment)
+                if log is not None:
+                    # inside the coalescer, so that skipped writes are not logged.
+                    write_lines = self.compile_log(write_lines, log, WRITE)
+                    pulse_lines = self.compile_log(pulse_lines, log, PULSE)
+                if text_log(self.experiment):
+                    write_lines = self.compile_text_log(write_lines, WRITE)
+                    pulse_lines = self.compile_text_log(pulse_lines, PULSE)
+            if mode == u'Pulse output lines':
+                def send():
+                    lines[key] = None
+                    pulse_lines(state[key] ^ mask, duration)
+            else:
+                if self.var.coalesce_writes == 'yes':
+                    write_lines = self.compile_coalesce(write_lines)
+                if mode == u'Invert output lines':
+                    def send():
+                        state[key] ^= mask
+                        write_lines(state[key])
+                        lines[key] = state[key]
+                else:
+                    value = 0 if mode == u'Clear output lines' else mask
+                    def send():
+                        state[key] = value
+                        write_lines(value)
+                        lines[key] = value
+        oslogger.info('{}: {} with byte code {}'.format(open_devices[key], mode, mask))
+        other_writer = self.other_writer
+        if other_writer is None:
+            return send
+        def drain_and_send():
+            other_writer.drain() # e.g. a sequence that is still playing.
+            send()
+        return drain_and_send
+
+    def compile_coalesce(self, write_lines):
+        """Returns a callable that writes the output lines, but skips the
+        write when the lines already have the value, and counts the skipped
+        writes."""
+        key = self.current_device
+        lines = device_line_value # updated by send() after the write.
+        name = self.name
+        var_name = u'skipped_writes_' + name
+        set_var = self.experiment.var.set
+        def write_changed(value):
+            if lines.get(key) == value:
+                skipped_writes[name] += 1
+                set_var(var_name, skipped_writes[name])
+                return
+            write_lines(value)
+        return write_changed
+
+    def compile_done(self, kind):
+        """Returns the callable that the writer thread calls when a write
+        has completed. It stores the completion time, on the experiment
+        clock, and the time from the request to the completion, both in ms,
+        and adds the write to the event log at the time it completed."""
+        name = self.name
+        set_var = self.experiment.var.set
+        clock_offset = self.clock.time() - perf_counter_ns() / 1000000
+        sequence_done = self.sequence_done
+        log = event_log(self.experiment)
+        if log is not None:
+            add = log.add
+            plugin = log.plugin_id(name)
+            device = log.device_id(self.current_device)
+            duration = self.var.duration if kind == PULSE else 0
+        def done(value, t_request, t_complete):
+            set_var(u'trigger_write_time_' + name, t_complete / 1000000 + clock_offset)
+            set_var(u'trigger_write_delay_' + name, (t_complete - t_request) / 1000000)
+            if kind == SEQUENCE:
+                sequence_done(value)
+                if log is not None:
+                    # logged at the start of the sequence, with its length.
+                    add(plugin, device, kind, value.values[0],
+                        value.offsets[-1] / 1000000, t_complete - value.times[-1])
+            elif log is not None:
+                add(plugin, device, kind, value, duration, t_complete)
+        return done
+
+    def compile_log(self, write, log, kind):
+        """Returns a callable that does a synchronous device write and adds
+        it to the event log. It takes the arguments of the write. The writes
+        of the writer thread are logged by compile_done()."""
+        add = log.add
+        plugin = log.plugin_id(self.name)
+        device = log.device_id(self.current_device)
+        if kind == PULSE:
+            def write_and_log(value, duration):
+                write(value, duration)
+                add(plugin, device, kind, value, duration)
         else:
-            if self.var.outputmode == u'Clear output lines':
-                # Store output state as global. (There is no read-back from the hardware.)
-                device_output_value[self.current_device] = 0
-                open_devices[self.current_device].write_lines(device_output_value[self.current_device])
-                oslogger.info('{}: send byte code {}'.format(
-                    open_devices[self.current_device], device_output_value[self.current_device]))
-            elif self.var.outputmode == u'Write output lines':
-                device_output_value[self.current_device] = self.var.mask
-                open_devices[self.current_device].write_lines(device_output_value[self.current_device])
-                oslogger.info('{}: send byte code {}'.format(
-                    open_devices[self.current_device], device_output_value[self.current_device]))
-            elif self.var.outputmode == u'Invert output lines':
-                device_output_value[self.current_device] ^= self.var.mask
-                open_devices[self.current_device].write_lines(device_output_value[self.current_device])
-                oslogger.info('{}: send byte code {}'.format(
-                    open_devices[self.current_device], device_output_value[self.current_device]))
-            elif self.var.outputmode == u'Pulse output lines':
-                open_devices[self.current_device].pulse_lines(
-                    (device_output_value[self.current_device] ^ self.var.mask), self.var.duration)
+            def write_and_log(value):
+                write(value)
+                add(plugin, device, kind, value)
+        return write_and_log
+
+    def compile_text_log(self, write, kind):
+        """Returns a callable that does a synchronous device write and logs
+        it as text. It takes the arguments of the write. The writes of the
+        writer thread are logged by the writer."""
+        handle = open_devices[self.current_device]
+        if kind == PULSE:
+            def write_and_log(value, duration):
+                write(value, duration)
                 oslogger.info('{}: send byte code {} for the duration of {} ms'.format(
-                    open_devices[self.current_device],
-                    device_output_value[self.current_device] ^ self.var.mask, self.var.duration))
-        # close the device?
-        if self.var.close_device == 'yes':
-            for dkey in open_devices:
-                try:
-                    open_devices[dkey].close()
-                    oslogger.info('Device: {} successfully closed!'.format(open_devices[dkey]))
-                except:
-                    oslogger.warning('Device {} for closing not found!'.format(open_devices[dkey]))
-
+                    handle, value, duration))
+        else:
+            def write_and_log(value):
+                write(value)
+                oslogger.info('{}: send byte code {}'.format(handle, value))
+        return write_and_log
+
+    def send_dummy(self):
+        """Logs the trigger that would have been sent."""
+        if self.var.outputmode == u'Clear output lines':
+            self.output_value = 0
+            oslogger.info('dummy: send byte code {}'.format(self.output_value))
+        elif self.var.outputmode == u'Write output lines':
+            self.output_value = self.var.mask
+            oslogger.info('dummy: send byte code {}'.format(self.output_value))
+        elif self.var.outputmode == u'Invert output lines':
+            self.output_value ^= self.var.mask
+            oslogger.info('dummy: send byte code {}'.format(self.output_value))
+        elif self.var.outputmode == u'Pulse output lines':
+            oslogger.info('dummy: send byte code {} for the duration of {} ms'.format(
+            self.output_value ^ self.var.mask, self.var.duration))
+        elif self.var.outputmode == u'Sequence output lines':
+            oslogger.info('dummy: send sequence {}'.format(self.var.sequence))
+
+    def sequence_done(self, sequence):
+        """Stores the measured step times of a sequence that has been
+        played. Called from the writer thread."""
+        self.experiment.var.set(u'sequence_step_times_' + self.name,
+                                sequence.step_times())
+        self.experiment.var.set(u'sequence_max_error_' + self.name,
+                                sequence.max_error())
 
 class QtEvtTrigger(EvtTrigger, QtAutoPlugin):
 
@@ -202,7 +380,7 @@ class QtEvtTrigger(EvtTrigger, QtAutoPlugin):
     def refresh_combobox_device(self):
         if self.refresh_checkbox_widget.isChecked():
             # renew list:
-            self.combobox_add_devices()
+            self.combobox_add_devices(refresh=True)
 
     def update_combobox_device(self):
         self.refresh_checkbox_widget.setChecked(False)
@@ -227,6 +405,7 @@ class QtEvtTrigger(EvtTrigger, QtAutoPlugin):
         else:
             self.byte_value_line_edit_widget.setEnabled(False)
             self.duration_line_edit_widget.setEnabled(False)
+        self.sequence_line_edit_widget.setEnabled(current_selection == 'Sequence output lines')
 
     def update_line_edit_value(self):
         # Calculate the decimal value from checkboxes. (How can we enumerate and loop this?)
@@ -273,20 +452,17 @@ class QtEvtTrigger(EvtTrigger, QtAutoPlugin):
             self.b6_checkbox_widget.setChecked(False)
             self.b7_checkbox_widget.setChecked(False)
 
-    def combobox_add_devices(self):
+    def combobox_add_devices(self, refresh=False):
+        # Scan in the background, the combobox is filled when the scan is done.
+        request_devices(_DEVICE_GROUP, self.combobox_fill_devices, refresh)
+
+    def combobox_fill_devices(self, device_list):
+        # Refill the list without triggering the currentIndexChanged signal,
+        # which would apply the intermediate selections to var.device.
+        self.device_combobox_widget.blockSignals(True)
         self.device_combobox_widget.clear()
         self.device_combobox_widget.addItem(u'DUMMY', userData=None)
-        
-        # Create the EVT device list
-        sleep(.5) # delay after possible init of a previous instance of this plugin. 
-        myevt = EventExchanger()
-        sleep(.2)
-        try:
-            device_list = myevt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-            del myevt
-        except:
-            device_list = {}
-        
+
         try:
             previous_device_found = False
             for d in device_list:
@@ -307,6 +483,10 @@ class QtEvtTrigger(EvtTrigger, QtAutoPlugin):
             self.var.device = u'DUMMY'
             oslogger.warning("The hardware configuration has been changed since the last run! Switching to dummy.")
 
+        self.device_combobox_widget.setCurrentIndex(
+            max(self.device_combobox_widget.findText(self.var.device), 0))
+        self.device_combobox_widget.blockSignals(False)
+
     def close_device(self):
         if self.close_device_checkbox_widget.isChecked():
             self.var.close_device = 'yes'
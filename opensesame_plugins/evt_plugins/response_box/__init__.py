@@ -36,6 +36,22 @@ controls = [
         "label": "Timeout [ms]:",
         "name": "timeout_line_edit_widget",
         "tooltip": "Expecting a value in milliseconds or 'infinite'."
+    }, {
+        "type": "combobox",
+        "var": "collect",
+        "label": "Collect :",
+        "options": [
+            "First response",
+            "All responses in window"
+        ],
+        "name": "collect_combobox_widget",
+        "tooltip": "Collect the first response, or all presses and releases until the timeout"
+    }, {
+        "type": "checkbox",
+        "var": "reader_thread",
+        "label": "Read the device in a background thread (timestamped responses)",
+        "name": "reader_thread_checkbox_widget",
+        "tooltip": "Continuously read the RSP-12x into a timestamped buffer"
     }, {
         "type": "checkbox",
         "var": "close_device",
@@ -17,21 +17,24 @@ You should have received a copy of the GNU General Public License
 along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import math
-from time import sleep
+from time import perf_counter_ns
+from queue import (Queue, Empty)
 from libopensesame.py3compat import *
 from libopensesame.item import Item
 from libqtopensesame.items.qtautoplugin import QtAutoPlugin
 #from openexp.canvas import Canvas
 from libopensesame.oslogging import oslogger
 from openexp.keyboard import Keyboard
-from pyevt import EventExchanger
+from .._devices import (open_devices, find_device, group_devices, close_devices,
+    event_reader, instrument_devices)
+from .._reader import EdgeRecorder
+from .._qtscan import request_devices
+from .._buttons import button_table
+from .._eventlog import (event_log, text_log, RESPONSE)
 
 # constant
 _DEVICE_GROUP = u'RSP'
-
-# global var
-open_devices = {} # Store open device handles.
+_ALL_DEVICES = u'All RSP devices'
 
 
 class ResponseBox(Item):
@@ -44,6 +47,8 @@ class ResponseBox(Item):
         self.var.correct_response = u'1'
         self.var.allowed_responses = u'1;2'
         self.var.timeout = u'infinite'
+        self.var.collect = u'First response'
+        self.var.reader_thread = 'no'
         self.var.close_device = 'no'
 
     def prepare(self):
@@ -67,43 +72,28 @@ class ResponseBox(Item):
             list_allowed_buttons.append(x)
         #oslogger.info('{}'.format(list_allowed_buttons))
         #oslogger.info('{}'.format(self.var.combined_allowed_events))
+        # lookup table to decode the button masks from the RSP-12x:
+        self.button_table = button_table(self.var.combined_allowed_events)
 
+        instrument_devices(self.experiment) # measure the device calls, if enabled.
+        self.reader = None
+        self.collect_all = self.var.collect == u'All responses in window'
+        if self.collect_all and type(self.var.timeout) != int:
+            oslogger.warning("Collecting all responses needs a timeout! Collecting the first response.")
+            self.collect_all = False
         if self.var.device == u'Keyboard':
             self.my_keyboard = Keyboard(self.experiment, 
                                 keylist=list_allowed_buttons,
                                 timeout=self.var.timeout if \
                                 type(self.var.timeout)==int else None)
-        elif len(open_devices) == 0:
-            # Create a shadow device list to find 'path' from the current selected device.
-            # 'path' is an unique device ID.
-            temp_evt = EventExchanger()
-            sleep(1) # without a delay, the list will not always be complete.
+        elif self.var.device == _ALL_DEVICES:
+            self.prepare_boxes(list_allowed_buttons)
+        else:
             try:
-                device_list = temp_evt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-                del temp_evt
-                # oslogger.info("device list: {}".format(device_list))
-                for d in device_list:
-                    sleep(1) # without a delays, the device will not always be there.
-                    composed_string = d['product_string'] + " s/n: " + d['serial_number']
-                    open_devices[composed_string] = EventExchanger()
-                    # Get evt device handle:
-                    open_devices[composed_string].attach_id(d['path'])
-                    oslogger.info('Device successfully attached as: {} s/n: {}'.format(
-                        d['product_string'], d['serial_number']))
-                    oslogger.info('        ...  and with device ID: {}'.format(
-                        open_devices[composed_string]))
+                self.current_device = find_device(_DEVICE_GROUP, self.var.device)
             except:
                 oslogger.warning("Loading the RSP-12x-box failed! Default is keyboard")
-                self.var.device = u'Keyboard'
-                self.my_keyboard = Keyboard(self.experiment, 
-                                            keylist=list_allowed_buttons,
-                                            timeout=self.var.timeout if \
-                                            type(self.var.timeout)==int else None)
-            # searching for selected device:
-            self.current_device = None
-            for dkey in open_devices:
-                if self.var.device[:15] in dkey:
-                    self.current_device = dkey # assign to value that belongs to the key.
+                self.current_device = None
             if self.current_device is None:
                 oslogger.warning("RSP-12x device not found! Device set to Keyboard.")
                 self.var.device = u'Keyboard'
@@ -114,30 +104,269 @@ class ResponseBox(Item):
             else:
                 oslogger.info('Preparing device: {}'.format(self.current_device))
                 # open_devices[self.current_device].write_lines(0) # clear lines
+                # Use the background reader when asked for, or when another
+                # item already started one for this device.
+                self.reader = event_reader(self.current_device,
+                                           start=self.var.reader_thread == 'yes' or \
+                                           self.collect_all)
+                if self.collect_all and not hasattr(self, 'edge_recorder'):
+                    self.edge_recorder = EdgeRecorder()
+
+        # structured event log, if enabled:
+        self.event_log = event_log(self.experiment)
+        self.text_log = text_log(self.experiment)
+        if self.event_log is not None:
+            self.log_plugin = self.event_log.plugin_id(self.name)
+            if self.var.device == _ALL_DEVICES:
+                # logged under the box that responded first, see publish_boxes().
+                self.log_device = self.event_log.device_id(self.var.device)
+                self.log_boxes = {dkey: self.event_log.device_id(dkey)
+                                  for dkey in self.box_devices}
+            elif self.var.device != u'Keyboard':
+                self.log_device = self.event_log.device_id(self.current_device)
 
         # pass device var to experiment as global:
         var_name = "self.experiment.var.connected_device_" + self.name
         exec(f'{var_name} = "{self.var.device}"')
 
+    def prepare_boxes(self, list_allowed_buttons):
+        """Prepares collecting from all connected RSP devices at once. Every
+        device gets a background reader that feeds one shared queue."""
+        try:
+            self.box_devices = group_devices(_DEVICE_GROUP)
+        except:
+            oslogger.warning("Loading the RSP-12x-boxes failed! Default is keyboard")
+            self.box_devices = []
+        if len(self.box_devices) == 0:
+            oslogger.warning("No RSP-12x devices found! Device set to Keyboard.")
+            self.var.device = u'Keyboard'
+            self.my_keyboard = Keyboard(self.experiment,
+                                        keylist=list_allowed_buttons,
+                                        timeout=self.var.timeout if \
+                                        type(self.var.timeout)==int else None)
+            return
+        if self.collect_all:
+            oslogger.warning("Collecting all responses is not supported for multiple boxes!")
+            self.collect_all = False
+        if not hasattr(self, 'box_queue'):
+            self.box_queue = Queue()
+        self.box_readers = {}
+        for dkey in self.box_devices:
+            oslogger.info('Preparing device: {}'.format(dkey))
+            self.box_readers[dkey] = event_reader(dkey)
+            self.box_readers[dkey].add_listener(self.box_queue, dkey)
+
+    def collect_boxes(self, deadline, block=True):
+        """Takes the events from the shared queue and keeps the first
+        allowed response of every box.
+
+        Parameters
+        ----------
+        deadline : int, NoneType
+            The end of the response window in ns or `None` for no timeout.
+        block : bool, optional
+            Wait for events, or only take the events that are queued.
+
+        Returns
+        -------
+        bool
+            `True` when all boxes have responded or the deadline has passed.
+        """
+        allowed_events = self.var.combined_allowed_events
+        while len(self.box_pending) > 0:
+            remaining = None
+            if deadline is not None:
+                remaining = (deadline - perf_counter_ns()) / 1e9
+                if remaining <= 0:
+                    return True
+            try:
+                if block:
+                    dkey, mask, t = self.box_queue.get(timeout=remaining)
+                else:
+                    dkey, mask, t = self.box_queue.get_nowait()
+            except Empty:
+                if not block:
+                    return False
+                continue
+            if t is None: # the reader of the box has ended.
+                self.box_pending.discard(dkey)
+            elif dkey in self.box_pending and t >= self.t0_ns and mask & allowed_events:
+                self.box_responses[dkey] = (mask, t)
+                self.box_pending.discard(dkey)
+        return True
+
+    def start_boxes(self):
+        while not self.box_queue.empty(): # drop the events from before the onset
+            self.box_queue.get_nowait()
+        self.t0_ns = perf_counter_ns()
+        # a box of which the reader has ended does not respond anymore.
+        self.box_pending = set(dkey for dkey in self.box_devices
+                               if not self.box_readers[dkey].closed)
+        self.box_responses = {}
+
+    def publish_boxes(self, timeout):
+        """Passes the first response of every box to the experiment
+        variables. The earliest response is used as the response."""
+        self.var.response = -1
+        self.var.end_time = timeout
+        self.first_box = None
+        t_first = None
+        for i, dkey in enumerate(self.box_devices, 1):
+            mask, t = self.box_responses.get(dkey, (-1, None))
+            button = self.button_table[mask][0] if mask > 0 else -1
+            response_time = -1 if t is None else (t - self.t0_ns) / 1000000
+            self.experiment.var.set(u'rsp_box{}_device'.format(i), dkey)
+            self.experiment.var.set(u'rsp_box{}_response'.format(i), button)
+            self.experiment.var.set(u'rsp_box{}_response_time'.format(i), response_time)
+            if t is not None and (t_first is None or t < t_first):
+                t_first = t
+                self.first_box = dkey
+                self.var.response = mask
+                self.var.end_time = response_time
+
     def run(self):
         """The run phase of the plug-in goes here."""
 
-        if self.var.device != u'Keyboard':
+        if self.var.device == _ALL_DEVICES:
+            t0 = self.set_item_onset() # Save the current time.
+            timeout = self.var.timeout if type(self.var.timeout) == int else None
+            self.start_boxes()
+            self.collect_boxes(None if timeout is None else \
+                               self.t0_ns + timeout * 1000000)
+            self.publish_boxes(timeout)
+            self.decode_response()
+        elif self.var.device != u'Keyboard':
             t0 = self.set_item_onset() # Save the current time.
-            self.var.response, self.var.end_time = \
-                    open_devices[self.current_device].wait_for_event(
-                        self.var.combined_allowed_events,
-                        self.var.timeout if type(self.var.timeout) == int else None)
-
-            # Decode output to knob number:
-            if self.var.response > 0:
-                self.var.response = math.log2(self.var.response) + 1
+            timeout = self.var.timeout if type(self.var.timeout) == int else None
+            if self.collect_all:
+                # Record all presses and releases until the window closes.
+                t0_ns = perf_counter_ns()
+                self.edge_recorder.record_window(
+                    self.reader, self.var.combined_allowed_events, t0_ns, timeout)
+                self.publish_window(t0_ns, timeout)
+            elif self.reader is not None:
+                # Get the first allowed event after the onset from the ring buffer.
+                t0_ns = perf_counter_ns()
+                self.var.response, t_response = self.reader.wait_for_event(
+                    self.var.combined_allowed_events, t0_ns, timeout)
+                self.var.end_time = timeout if t_response is None else \
+                    (t_response - t0_ns) / 1000000
             else:
-                self.var.response = -1
+                self.var.response, self.var.end_time = \
+                        open_devices[self.current_device].wait_for_event(
+                            self.var.combined_allowed_events, timeout)
+            if not self.collect_all:
+                self.decode_response()
         else:
             # Get keyboard response...
             t0 = self.set_item_onset() # Save the current time.
             self.var.response, self.var.end_time = self.my_keyboard.get_key()
+        self.process_response()
+
+    def coroutine(self):
+        """Collects the response without blocking, so that the item can run
+        inside a coroutines item. Every tick costs a single non-blocking
+        read of the device or of the reader's ring buffer.
+        """
+        timeout = self.var.timeout if type(self.var.timeout) == int else None
+        allowed_events = self.var.combined_allowed_events
+        # all responses are only collected from a single box, see prepare().
+        collect_all = self.collect_all and self.var.device != u'Keyboard'
+        if self.var.device == u'Keyboard':
+            self.my_keyboard.timeout = 0
+        elif self.var.device == _ALL_DEVICES:
+            pass
+        elif self.reader is None:
+            device = open_devices[self.current_device].device
+            while device.read(1): # flush the buffer
+                pass
+        alive = True
+        yield
+        t0 = self.set_item_onset()
+        t0_ns = perf_counter_ns()
+        if self.var.device == _ALL_DEVICES:
+            self.start_boxes()
+        elif collect_all:
+            # Record all presses and releases until the window closes.
+            self.edge_recorder.start(self.reader, allowed_events, t0_ns)
+        elif self.reader is not None:
+            n = self.reader.first_index(t0_ns)
+        self.var.response = -1
+        self.var.end_time = timeout
+        while alive:
+            if self.var.device == _ALL_DEVICES:
+                if self.collect_boxes(None if timeout is None else \
+                                      t0_ns + timeout * 1000000, block=False):
+                    break
+            elif self.var.device == u'Keyboard':
+                key, key_time = self.my_keyboard.get_key()
+                if key is not None:
+                    self.var.response, self.var.end_time = key, key_time
+                    break
+                if timeout is not None and \
+                        perf_counter_ns() - t0_ns >= timeout * 1000000:
+                    self.var.response = None # as get_key() on a timeout.
+                    break
+            elif collect_all:
+                if self.edge_recorder.poll(t0_ns + timeout * 1000000):
+                    break
+            else:
+                if self.reader is not None:
+                    response, t_response, n = self.reader.poll(allowed_events, n)
+                else:
+                    last_event = device.read(1)
+                    t_response = perf_counter_ns()
+                    response = last_event[0] if last_event and \
+                        last_event[0] & allowed_events else -1
+                if response > 0:
+                    self.var.response = response
+                    self.var.end_time = (t_response - t0_ns) / 1000000
+                    break
+                if timeout is not None and \
+                        perf_counter_ns() - t0_ns >= timeout * 1000000:
+                    break
+            alive = yield
+        if self.var.device == _ALL_DEVICES:
+            self.publish_boxes(timeout)
+        if collect_all:
+            self.publish_window(t0_ns, timeout)
+        elif self.var.device != u'Keyboard':
+            self.decode_response()
+        self.process_response()
+
+    def decode_response(self):
+        """Decodes the button mask from the device to the button number(s)."""
+        if self.var.response > 0:
+            self.var.response, self.var.response_buttons, allowed = \
+                self.button_table[self.var.response]
+        else:
+            self.var.response = -1
+            self.var.response_buttons = []
+
+    def publish_window(self, t0_ns, timeout):
+        """Passes all presses and releases of the response window to the
+        experiment variables. The first press is used as the response."""
+        buttons, press_times, release_times, hold_durations = \
+            self.edge_recorder.summary(t0_ns)
+        self.experiment.var.rsp_press_count = len(buttons)
+        self.experiment.var.rsp_presses = buttons
+        self.experiment.var.rsp_press_times = press_times
+        self.experiment.var.rsp_release_times = release_times
+        self.experiment.var.rsp_hold_durations = hold_durations
+        if len(buttons) > 0:
+            self.var.response = buttons[0]
+            self.var.end_time = press_times[0]
+            self.var.response_buttons = buttons
+        else:
+            self.var.response = -1
+            self.var.end_time = timeout
+            self.var.response_buttons = []
+
+    def process_response(self):
+        """Passes the response to the OpenSesame responses."""
+        if self.var.device == u'Keyboard':
+            self.var.response_buttons = [] if self.var.response is None \
+                else [self.var.response]
 
         # Pass all response data to the Opensesame response item.
         self.experiment.responses.add(response_time = self.var.end_time, \
@@ -146,13 +375,23 @@ class ResponseBox(Item):
                                       response = self.var.response, \
                                       item=self.name)
 
+        if self.event_log is not None and self.var.device != u'Keyboard':
+            log_device = self.log_device
+            if self.var.device == _ALL_DEVICES and self.first_box is not None:
+                log_device = self.log_boxes[self.first_box]
+            self.event_log.add(self.log_plugin, log_device, RESPONSE,
+                               self.var.response, -1 if self.var.end_time is None \
+                               else self.var.end_time)
+
+        if self.text_log and self.var.device != u'Keyboard':
+            oslogger.info('{}: response {} after {} ms'.format(
+                self.name, self.var.response, self.var.end_time))
+
         if self.var.close_device == 'yes':
-            for dkey in open_devices:
-                try:
-                    open_devices[dkey].close()
-                    oslogger.info('Device: {} successfully closed!'.format(open_devices[dkey]))
-                except:
-                    oslogger.warning('Device {} for closing not found!'.format(open_devices[dkey]))
+            if self.var.device == _ALL_DEVICES:
+                close_devices(self.box_devices)
+            elif self.var.device != u'Keyboard':
+                close_devices([self.current_device])
 
 
 class QtResponseBox(ResponseBox, QtAutoPlugin):
@@ -193,7 +432,7 @@ class QtResponseBox(ResponseBox, QtAutoPlugin):
     def refresh_combobox_device(self):
         if self.refresh_checkbox_widget.isChecked():
             # renew list:
-            self.combobox_add_devices()
+            self.combobox_add_devices(refresh=True)
 
     def update_combobox_device(self):
         self.refresh_checkbox_widget.setChecked(False)
@@ -212,21 +451,23 @@ class QtResponseBox(ResponseBox, QtAutoPlugin):
             self.timeout_line_edit_widget.setText('')
             self.timeout_line_edit_widget.blockSignals(False)
 
-    def combobox_add_devices(self):
+    def combobox_add_devices(self, refresh=False):
+        # Scan in the background, the combobox is filled when the scan is done.
+        request_devices(_DEVICE_GROUP, self.combobox_fill_devices, refresh)
+
+    def combobox_fill_devices(self, device_list):
+        # Refill the list without triggering the currentIndexChanged signal,
+        # which would apply the intermediate selections to var.device.
+        self.device_combobox_widget.blockSignals(True)
         self.device_combobox_widget.clear()
         self.device_combobox_widget.addItem(u'Keyboard', userData=None)
-        
-        # Create the EVT device list
-        sleep(1) # delay after possible init of a previous instance of this plugin. 
-        myevt = EventExchanger()
-        try:
-            device_list = myevt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-            del myevt
-        except:
-            device_list = {}
-        
+
         try:
             previous_device_found = False
+            if len(device_list) > 1:
+                # collect from all boxes at once:
+                self.device_combobox_widget.addItem(_ALL_DEVICES)
+                previous_device_found = self.var.device == _ALL_DEVICES
             for d in device_list:
                 product_string = d['product_string']
                 serial_string = d['serial_number']
@@ -234,7 +475,7 @@ class QtResponseBox(ResponseBox, QtAutoPlugin):
                 # add device id to combobox:
                 self.device_combobox_widget.addItem(composed_string)
                 # previous used device present?
-                if self.var.device[:15] in product_string:
+                if self.var.device != _ALL_DEVICES and self.var.device[:15] in product_string:
                     self.var.device = composed_string
                     previous_device_found = True       
         except:
@@ -245,6 +486,10 @@ class QtResponseBox(ResponseBox, QtAutoPlugin):
             self.var.device = u'Keyboard'
             oslogger.warning("The hardware configuration has been changed since the last run! Switching to dummy.")
 
+        self.device_combobox_widget.setCurrentIndex(
+            max(self.device_combobox_widget.findText(self.var.device), 0))
+        self.device_combobox_widget.blockSignals(False)
+
     def close_device(self):
         if self.close_device_checkbox_widget.isChecked():
             self.var.close_device = 'yes'
@@ -18,10 +18,13 @@ along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import time
-import math
+from time import perf_counter_ns
 import distutils.util
-from time import sleep
-from pyevt import EventExchanger
+from .._devices import (open_devices, find_device, close_devices, event_reader,
+    instrument_devices)
+from .._qtscan import request_devices
+from .._buttons import button_table
+from .._eventlog import (event_log, text_log, RESPONSE, LED)
 from libopensesame.item import Item
 from libqtopensesame.items.qtautoplugin import QtAutoPlugin
 from openexp.canvas import Canvas
@@ -31,9 +34,6 @@ from openexp.keyboard import Keyboard
 # constant
 _DEVICE_GROUP = u'RSP-LT'
 
-# global var
-open_devices = {} # Store open device handles.
-
 
 class RgbLedControl(Item):
 
@@ -78,43 +78,21 @@ class RgbLedControl(Item):
             list_allowed_buttons.append(x)
         #oslogger.info('{}'.format(list_allowed_buttons))
         #oslogger.info('{}'.format(self.var.combined_allowed_events))
+        # lookup table to decode the button masks from the RSP-LT:
+        self.button_table = button_table(self.var.combined_allowed_events)
 
+        instrument_devices(self.experiment) # measure the device calls, if enabled.
         if self.var.device == u'Keyboard':
             self.my_keyboard = Keyboard(self.experiment, 
                                 keylist=list_allowed_buttons,
                                 timeout=self.var.timeout if \
                                 type(self.var.timeout)==int else None)
-        elif len(open_devices) == 0:
-            # Create a shadow device list to find 'path' from the current selected device.
-            # 'path' is an unique device ID.
-            temp_evt = EventExchanger()
-            sleep(1) # without a delay, the list will not always be complete.
+        else:
             try:
-                device_list = temp_evt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-                del temp_evt
-                # oslogger.info("device list: {}".format(device_list))
-                for d in device_list:
-                    sleep(1) # without a delays, the device will not always be there.
-                    composed_string = d['product_string'] + " s/n: " + d['serial_number']
-                    open_devices[composed_string] = EventExchanger()
-                    # Get evt device handle:
-                    open_devices[composed_string].attach_id(d['path'])
-                    oslogger.info('Device successfully attached as: {} s/n: {}'.format(
-                        d['product_string'], d['serial_number']))
-                    oslogger.info('        ...  and with device ID: {}'.format(
-                        open_devices[composed_string]))
+                self.current_device = find_device(_DEVICE_GROUP, self.var.device)
             except:
                 oslogger.warning("Loading the RSP-12x-box failed! Default is keyboard")
-                self.var.device = u'Keyboard'
-                self.my_keyboard = Keyboard(self.experiment, 
-                                            keylist=list_allowed_buttons,
-                                            timeout=self.var.timeout if \
-                                            type(self.var.timeout)==int else None)
-            # searching for selected device:
-            self.current_device = None
-            for dkey in open_devices:
-                if self.var.device[:15] in dkey:
-                    self.current_device = dkey # assign to value that belongs to the key.
+                self.current_device = None
             if self.current_device is None:
                 oslogger.warning("RSP-12x device not found! Device set to Keyboard.")
                 self.var.device = u'Keyboard'
@@ -126,6 +104,14 @@ class RgbLedControl(Item):
                 oslogger.info('Preparing device: {}'.format(self.current_device))
                 # open_devices[self.current_device].write_lines(0) # clear lines
 
+        # structured event log, if enabled:
+        self.event_log = event_log(self.experiment)
+        self.text_log = text_log(self.experiment)
+        if self.event_log is not None:
+            self.log_plugin = self.event_log.plugin_id(self.name)
+            if self.var.device != u'Keyboard':
+                self.log_device = self.event_log.device_id(self.current_device)
+
         # pass device var to experiment as global:
         var_name = "self.experiment.var.connected_device_" + self.name
         exec(f'{var_name} = "{self.var.device}"')
@@ -135,6 +121,110 @@ class RgbLedControl(Item):
         # Save the current time...
         t0 = self.set_item_onset()
 
+        if self.var.device != u'Keyboard':
+            timeout = self.var.timeout if type(self.var.timeout) == int else None
+            # A background reader of another item owns the device reads.
+            reader = event_reader(self.current_device, start=False)
+            self.set_led_colors()
+
+            if reader is not None:
+                t0_ns = perf_counter_ns()
+                self.var.response, t_response = reader.wait_for_event(
+                    self.var.combined_allowed_events, t0_ns, timeout)
+                self.var.keyboard_response = timeout if t_response is None else \
+                    (t_response - t0_ns) / 1000000
+            else:
+                # Call the 'wait for event' function in \
+                # the EventExchanger C# object.
+                self.var.response, self.var.keyboard_response = \
+                    open_devices[self.current_device].wait_for_event(
+                        self.var.combined_allowed_events, timeout)
+
+            if (self.var.response != -1):
+                self.var.response, self.var.response_buttons, allowed = \
+                    self.button_table[self.var.response]
+            else:
+                self.var.response_buttons = []
+
+            # Feedback:
+            if self.var.feedback == u'yes':
+                time.sleep(self.var.reset_delay / 1000.0)
+                self.reset_led_colors()
+        else:
+            # dummy-mode: keyboard response.....
+            self.var.response, self.var.keyboard_response = \
+                self.my_keyboard.get_key()
+            self.var.response_buttons = [] if self.var.response is None \
+                else [self.var.response]
+        self.process_response()
+
+    def coroutine(self):
+        """Collects the response without blocking, so that the item can run
+        inside a coroutines item. Every tick costs a single non-blocking
+        read of the device or of the reader's ring buffer. The feedback
+        colors are also reset without blocking.
+        """
+        timeout = self.var.timeout if type(self.var.timeout) == int else None
+        allowed_events = self.var.combined_allowed_events
+        reader = None
+        if self.var.device == u'Keyboard':
+            self.my_keyboard.timeout = 0
+        else:
+            # A background reader of another item owns the device reads.
+            reader = event_reader(self.current_device, start=False)
+            if reader is None:
+                device = open_devices[self.current_device].device
+                while device.read(1): # flush the buffer
+                    pass
+        alive = True
+        yield
+        t0 = self.set_item_onset()
+        t0_ns = perf_counter_ns()
+        self.var.response = -1
+        self.var.response_buttons = []
+        self.var.keyboard_response = timeout
+        if self.var.device != u'Keyboard':
+            self.set_led_colors()
+        if reader is not None:
+            n = reader.first_index(t0_ns)
+        while alive:
+            if self.var.device == u'Keyboard':
+                key, key_time = self.my_keyboard.get_key()
+                if key is not None:
+                    self.var.response, self.var.keyboard_response = key, key_time
+                    self.var.response_buttons = [key]
+                    break
+                if timeout is not None and \
+                        perf_counter_ns() - t0_ns >= timeout * 1000000:
+                    self.var.response = None # as get_key() on a timeout.
+                    break
+            else:
+                if reader is not None:
+                    response, t_response, n = reader.poll(allowed_events, n)
+                else:
+                    last_event = device.read(1)
+                    t_response = perf_counter_ns()
+                    response = last_event[0] if last_event and \
+                        last_event[0] & allowed_events else -1
+                if response > 0:
+                    self.var.response, self.var.response_buttons, allowed = \
+                        self.button_table[response]
+                    self.var.keyboard_response = (t_response - t0_ns) / 1000000
+                    break
+                if timeout is not None and \
+                        perf_counter_ns() - t0_ns >= timeout * 1000000:
+                    break
+            alive = yield
+        if self.var.device != u'Keyboard' and self.var.feedback == u'yes':
+            # Keep the feedback colors on during the reset delay.
+            t_reset = perf_counter_ns() + self.var.reset_delay * 1000000
+            while alive and perf_counter_ns() < t_reset:
+                alive = yield
+            self.reset_led_colors()
+        self.process_response()
+
+    def set_led_colors(self):
+        """Sets the button colors and, with feedback, the feedback colors."""
         hexprepend = "0x"
         self.colors = [hexprepend + self.var.button1_color[1:],
                        hexprepend + self.var.button2_color[1:],
@@ -149,49 +239,43 @@ class RgbLedControl(Item):
         for b in range(4):
             BLC[b] = int(self.colors[b], 16)
 
-        if self.var.device != u'Keyboard':
-            for b in range(4):
-                open_devices[self.current_device].set_led_rgb(
-                    ((BLC[b] >> 16) & 0xFF),
-                    ((BLC[b] >> 8) & 0xFF),
-                    (BLC[b] & 0xFF),
-                    b + 1, 1)
-
-            if self.var.feedback == u'yes':
-                for b in range(4):
-                    open_devices[self.current_device].set_led_rgb(
-                        ((IC >> 16) & 0xFF),
-                        ((IC >> 8) & 0xFF),
-                        (IC & 0xFF),
-                        b + 1, b + 11)
+        for b in range(4):
+            open_devices[self.current_device].set_led_rgb(
+                ((BLC[b] >> 16) & 0xFF),
+                ((BLC[b] >> 8) & 0xFF),
+                (BLC[b] & 0xFF),
+                b + 1, 1)
 
+        if self.var.feedback == u'yes':
+            for b in range(4):
                 open_devices[self.current_device].set_led_rgb(
-                    ((CC >> 16) & 0xFF),
-                    ((CC >> 8) & 0xFF),
-                    (CC & 0xFF),
-                    int(self.var.correct_response),
-                    int(self.var.correct_response) + 10)
-
-            # Call the 'wait for event' function in \
-            # the EventExchanger C# object.
-            self.var.response, self.var.keyboard_response = \
-                open_devices[self.current_device].wait_for_event(
-                    self.var.combined_allowed_events, self.var.timeout if \
-                    type(self.var.timeout)==int else None)
-
-            if (self.var.response != -1):
-                self.var.response = math.log2(self.var.response) + 1
-
-            # Feedback:
-            if self.var.feedback == u'yes':
-                time.sleep(self.var.reset_delay / 1000.0)
-                for b in range(4):
-                    open_devices[self.current_device].set_led_rgb(0, 0, 0, b + 1, 1)
-        else:
-            # dummy-mode: keyboard response.....
-            self.var.response, self.var.keyboard_response = \
-                self.my_keyboard.get_key()
-
+                    ((IC >> 16) & 0xFF),
+                    ((IC >> 8) & 0xFF),
+                    (IC & 0xFF),
+                    b + 1, b + 11)
+
+            open_devices[self.current_device].set_led_rgb(
+                ((CC >> 16) & 0xFF),
+                ((CC >> 8) & 0xFF),
+                (CC & 0xFF),
+                int(self.var.correct_response),
+                int(self.var.correct_response) + 10)
+
+        if self.event_log is not None:
+            self.event_log.add(self.log_plugin, self.log_device, LED, 1)
+        if self.text_log:
+            oslogger.info('{}: LED colors set'.format(open_devices[self.current_device]))
+
+    def reset_led_colors(self):
+        for b in range(4):
+            open_devices[self.current_device].set_led_rgb(0, 0, 0, b + 1, 1)
+        if self.event_log is not None:
+            self.event_log.add(self.log_plugin, self.log_device, LED, 0)
+        if self.text_log:
+            oslogger.info('{}: LED colors reset'.format(open_devices[self.current_device]))
+
+    def process_response(self):
+        """Passes the response to the OpenSesame responses."""
         # HOUSE KEEPING:
         self.var.correct = \
             bool(self.var.response == self.var.correct_response)
@@ -204,14 +288,16 @@ class RgbLedControl(Item):
                                       correct=self.var.correct,
                                       response=self.var.response,
                                       item=self.name)
+        if self.event_log is not None and self.var.device != u'Keyboard':
+            self.event_log.add(self.log_plugin, self.log_device, RESPONSE,
+                               self.var.response, -1 if self.var.keyboard_response \
+                               is None else self.var.keyboard_response)
+        if self.text_log and self.var.device != u'Keyboard':
+            oslogger.info('{}: response {} after {} ms'.format(
+                self.name, self.var.response, self.var.keyboard_response))
         # close the device?
-        if self.var.close_device == 'yes':
-            for dkey in open_devices:
-                try:
-                    open_devices[dkey].close()
-                    oslogger.info('Device: {} successfully closed!'.format(open_devices[dkey]))
-                except:
-                    oslogger.warning('Device {} for closing not found!'.format(open_devices[dkey]))
+        if self.var.close_device == 'yes' and self.var.device != u'Keyboard':
+            close_devices([self.current_device])
 
 
 class QtRgbLedControl(RgbLedControl, QtAutoPlugin):
@@ -252,7 +338,7 @@ class QtRgbLedControl(RgbLedControl, QtAutoPlugin):
     def refresh_combobox_device(self):
         if self.refresh_checkbox_widget.isChecked():
             # renew list:
-            self.combobox_add_devices()
+            self.combobox_add_devices(refresh=True)
 
     def update_combobox_device(self):
         self.refresh_checkbox_widget.setChecked(False)
@@ -271,19 +357,17 @@ class QtRgbLedControl(RgbLedControl, QtAutoPlugin):
             self.timeout_line_edit_widget.setText('')
             self.timeout_line_edit_widget.blockSignals(False)
 
-    def combobox_add_devices(self):
+    def combobox_add_devices(self, refresh=False):
+        # Scan in the background, the combobox is filled when the scan is done.
+        request_devices(_DEVICE_GROUP, self.combobox_fill_devices, refresh)
+
+    def combobox_fill_devices(self, device_list):
+        # Refill the list without triggering the currentIndexChanged signal,
+        # which would apply the intermediate selections to var.device.
+        self.device_combobox_widget.blockSignals(True)
         self.device_combobox_widget.clear()
         self.device_combobox_widget.addItem(u'Keyboard', userData=None)
-        
-        # Create the EVT device list
-        sleep(1) # delay after possible init of a previous instance of this plugin. 
-        myevt = EventExchanger()
-        try:
-            device_list = myevt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-            del myevt
-        except:
-            device_list = {}
-        
+
         try:
             previous_device_found = False
             for d in device_list:
@@ -291,7 +375,7 @@ class QtRgbLedControl(RgbLedControl, QtAutoPlugin):
                 serial_string = d['serial_number']
                 composed_string = product_string[15:] + " s/n: " + serial_string
                 # add device id to combobox:
-                self.device_combobox_widget_widget.addItem(composed_string)
+                self.device_combobox_widget.addItem(composed_string)
                 # previous used device present?
                 if self.var.device[:15] in product_string:
                     self.var.device = composed_string
@@ -305,6 +389,10 @@ class QtRgbLedControl(RgbLedControl, QtAutoPlugin):
             oslogger.warning(
                 "The hardware configuration has been changed since the last run! Switching to Keyboard.")
 
+        self.device_combobox_widget.setCurrentIndex(
+            max(self.device_combobox_widget.findText(self.var.device), 0))
+        self.device_combobox_widget.blockSignals(False)
+
     def close_device(self):
         if self.close_device_checkbox_widget.isChecked():
             self.var.close_device = 'yes'
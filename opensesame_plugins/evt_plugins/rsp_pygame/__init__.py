@@ -35,6 +35,23 @@ controls = [
         "label": "Timeout period [ms]:",
         "name": "timeout_line_edit_widget",
         "tooltip": "Expecting a value in milliseconds or 'infinite'."
+    }, {
+        "type": "combobox",
+        "var": "wait_strategy",
+        "label": "Wait strategy :",
+        "options": [
+            "spin",
+            "hybrid",
+            "blocking"
+        ],
+        "name": "wait_strategy_combobox_widget",
+        "tooltip": "spin: lowest latency at full CPU load, hybrid: spin shortly then sleep 1 ms between polls, blocking: sleep until an event arrives"
+    }, {
+        "type": "checkbox",
+        "var": "end_on_release",
+        "label": "End on release",
+        "name": "end_on_release_checkbox_widget",
+        "tooltip": "End the item when the button is released, and store the release time and hold duration"
     }, {
         "type": "text",
         "label": "<small>Generic response box plug-in version 0.2.0</small>"
@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from libopensesame.py3compat import *
+import threading
+from time import (perf_counter, sleep)
+import numpy as np
+
+
+class AxisStream(threading.Thread):
+    """Samples all axes of a joystick at a fixed rate in a background thread.
+
+    The samples are stored in a preallocated float32 ring buffer. Every
+    sample is written twice, at index i and i + n_samples, so the latest
+    n_samples are always contiguous in memory and can be returned as a view
+    without copying.
+
+    SDL updates the axis state when the event queue is pumped. The samples
+    follow the stick as long as the experiment keeps pumping the queue, for
+    example by polling the joystick, keyboard or mouse, or by `flush()`.
+    """
+
+    def __init__(self, js, rate, n_samples, clock_offset):
+        """Initializes the stream.
+
+        Parameters
+        ----------
+        js : pygame.joystick.Joystick
+            An initialized joystick.
+        rate : int, float
+            The sample rate in Hz.
+        n_samples : int
+            The number of samples that the ring buffer holds.
+        clock_offset : float
+            The offset in ms from `1000 * perf_counter()` to the experiment
+            clock.
+        """
+        super().__init__(daemon=True)
+        self._js = js
+        self._period = 1 / rate
+        self._n = n_samples
+        self._n_axes = js.get_numaxes()
+        self._clock_offset = clock_offset
+        self._running = True
+        self.data = np.zeros((2 * n_samples, self._n_axes), dtype=np.float32)
+        self.time = np.zeros(2 * n_samples, dtype=np.float64)
+        self.count = 0 # total number of samples that were written.
+
+    def run(self):
+        get_axis = self._js.get_axis
+        axes = range(self._n_axes)
+        data = self.data
+        timestamps = self.time
+        n = self._n
+        period = self._period
+        offset = self._clock_offset
+        count = 0
+        next_t = perf_counter()
+        while self._running:
+            t = perf_counter()
+            row = [get_axis(axis) for axis in axes]
+            i = count % n
+            data[i] = row
+            data[i + n] = row
+            timestamps[i] = timestamps[i + n] = 1000 * t + offset
+            count += 1
+            self.count = count
+            next_t += period
+            delay = next_t - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            elif delay < -period:
+                next_t = perf_counter() # fallen behind, skip the missed samples.
+
+    def stop(self):
+        """Stops the sampler thread and waits until it has finished."""
+        self._running = False
+        if self.is_alive():
+            self.join()
+
+    def latest(self, n=None):
+        """Returns the latest samples as views on the ring buffer.
+
+        Parameters
+        ----------
+        n : int, NoneType, optional
+            The number of samples, or `None` for all samples that are in the
+            buffer.
+
+        Returns
+        -------
+        tuple
+            A (samples, timestamps) tuple of arrays with shapes (n, n_axes)
+            and (n,). The views are overwritten when the ring buffer wraps
+            around, so copy them if they must be kept.
+        """
+        count = self.count
+        n = min(count, self._n) if n is None else min(n, count, self._n)
+        end = (count - 1) % self._n + self._n + 1 if count > 0 else self._n
+        return self.data[end - n:end], self.time[end - n:end]
@@ -24,14 +24,24 @@ class BaseJoystick:
     JOYSTICK object automatically becomes part of the experiment object
     and can be used within an INLINE_SCRIPT item as `joystick`.
 
+    All timestamps are in milliseconds on the experiment clock, like the
+    values returned by `clock.time()`, with sub-millisecond resolution.
+
     {% set arg_joybuttonlist = "A list of buttons that are accepted or " +
     "`None` to accept all buttons." %}
     {% set arg_timeout = "A timeout value in milliseconds or `None` for no " +
     "timeout." %}
+    {% set arg_wait_strategy = "How to wait for input: 'spin' polls the " +
+    "event queue continuously, 'hybrid' polls continuously for the first " +
+    "milliseconds and then sleeps 1 ms between polls, and 'blocking' " +
+    "sleeps until an event arrives." %}
+    {% set arg_n_samples = "The number of samples that are kept in the " +
+    "ring buffer." %}
 
     [TOC]
     """
-    def __init__(self, experiment, device=0, joybuttonlist=None, timeout=None):
+    def __init__(self, experiment, device=0, joybuttonlist=None, timeout=None,
+                 wait_strategy=u'spin'):
         """Initializes the joystick object.
 
         Parameters
@@ -44,6 +54,8 @@ class BaseJoystick:
             {{arg_joybuttonlist}}
         timeout : int, float, NoneType, optional
             {{arg_timeout}}
+        wait_strategy : str, optional
+            {{arg_wait_strategy}}
         """
         raise NotImplementedError()
 
@@ -72,6 +84,35 @@ class BaseJoystick:
         """
         self.timeout = timeout
 
+    def set_wait_strategy(self, wait_strategy=u'spin'):
+        r"""Sets the wait strategy.
+
+        Parameters
+        ----------
+        wait_strategy : str, optional
+            {{arg_wait_strategy}}
+        """
+        if wait_strategy not in (u'spin', u'hybrid', u'blocking'):
+            raise ValueError(u'Invalid wait strategy: {}'.format(wait_strategy))
+        self.wait_strategy = wait_strategy
+
+    def set_axis_filter(self, dead_zone=0.0, min_delta=0.0):
+        r"""Filters out small axis movements, such as the jitter of an analog
+        stick. Filtered axis events are dropped, so `get_joyaxes()` and
+        `get_joyinput()` only return on a meaningful movement. Hat events
+        only pass when the hat position changes.
+
+        Parameters
+        ----------
+        dead_zone : float, optional
+            Axis values closer to zero than this are taken as zero, also in
+            the returned positions.
+        min_delta : float, optional
+            An axis event is dropped if its value differs less than this from
+            the last value that passed. A return to zero always passes.
+        """
+        raise NotImplementedError()
+
     def get_joybutton(self, joybuttonlist=None, timeout=None):
         r"""Collects joystick button input.
 
@@ -91,6 +132,26 @@ class BaseJoystick:
         """
         raise NotImplementedError()
 
+    def get_joybuttonrelease(self, joybutton, timeout=None):
+        r"""Waits for the release of a joystick button. Call this after
+        `get_joybutton()` to measure how long the button was held down; the
+        release is not lost when it arrived together with the press.
+
+        Parameters
+        ----------
+        joybutton : int
+            The button that was pressed.
+        timeout : int, float, NoneType, optional
+            A timeout value in milliseconds or `None` for no timeout.
+
+        Returns
+        -------
+        tuple
+            A (joybutton, timestamp) tuple. The joybutton is `None` if a
+            timeout occurs.
+        """
+        raise NotImplementedError()
+
     def get_joyaxes(self, timeout=None):
         r"""Waits for joystick axes movement.
 
@@ -159,6 +220,55 @@ class BaseJoystick:
         """
         raise NotImplementedError()
 
+    def start_axis_stream(self, rate=1000, n_samples=10000):
+        r"""Starts sampling all axes at a fixed rate into a preallocated ring
+        buffer. A stream that is already running is stopped first, and the
+        stream is stopped at the end of the experiment.
+
+        Parameters
+        ----------
+        rate : int, float, optional
+            The sample rate in Hz.
+        n_samples : int, optional
+            {{arg_n_samples}}
+        """
+        raise NotImplementedError()
+
+    def stop_axis_stream(self):
+        r"""Stops sampling the axes. The samples remain available until the
+        next call of `start_axis_stream()`."""
+        raise NotImplementedError()
+
+    def get_axis_stream(self, n=None):
+        r"""Gets the latest axis samples without copying them.
+
+        Parameters
+        ----------
+        n : int, NoneType, optional
+            The number of samples or `None` for all samples in the buffer.
+
+        Returns
+        -------
+        tuple
+            A `(samples, timestamps)` tuple of NumPy views with shapes
+            `(n, n_axes)` and `(n,)`. The views change when the ring buffer
+            wraps around, so copy them if they must be kept.
+        """
+        raise NotImplementedError()
+
+    def log_axis_stream(self, prefix=u'joystick'):
+        r"""Stores the samples in the buffer as experiment variables, so
+        that they are written to the log file by the next logger item. The
+        variables are `[prefix]_axis_times` and `[prefix]_axis[n]` for every
+        axis n, each holding a list.
+
+        Parameters
+        ----------
+        prefix : str, optional
+            The prefix of the variable names.
+        """
+        raise NotImplementedError()
+
     def input_options(self):
         r"""Generates a list with the number of available buttons, axes, balls
         and hats.
@@ -181,3 +291,10 @@ class BaseJoystick:
             flush) and False otherwise.
         """
         raise NotImplementedError()
+
+    def close(self):
+        r"""Releases the joystick at the end of the experiment. The joystick
+        no longer receives events, so that a next run of the experiment in
+        the same process starts clean.
+        """
+        raise NotImplementedError()
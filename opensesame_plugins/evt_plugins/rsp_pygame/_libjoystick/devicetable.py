@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from libopensesame.py3compat import *
+import pygame
+
+
+class DeviceTable:
+    """Keeps a table of the connected joysticks.
+
+    The table is built once and then kept up to date by the event pump,
+    which calls `update()` when SDL reports that a joystick was added or
+    removed. Without a running event loop, as in the editor, SDL only sees
+    new devices when the joystick module is initialized again, which is
+    what `devices(refresh=True)` does.
+    """
+
+    def __init__(self):
+        self._devices = None
+
+    def devices(self, refresh=False):
+        """Returns the connected joysticks.
+
+        Parameters
+        ----------
+        refresh : bool, optional
+            Initialize the joystick module again to look for new devices.
+            Do not use this while an experiment is running, because it
+            closes all joysticks.
+
+        Returns
+        -------
+        list
+            A list of (name, GUID, instance id) tuples, in the order of the
+            device index.
+        """
+        if refresh and pygame.joystick.get_init():
+            pygame.joystick.quit()
+        if refresh or self._devices is None:
+            self.update()
+        return list(self._devices)
+
+    def update(self):
+        """Reads the connected joysticks from SDL."""
+        if not pygame.joystick.get_init():
+            pygame.joystick.init()
+        devices = []
+        for i in range(pygame.joystick.get_count()):
+            js = pygame.joystick.Joystick(i)
+            devices.append((js.get_name(), js.get_guid(), js.get_instance_id()))
+        self._devices = devices
+
+
+# The table is shared by the editor and all joystick instances.
+device_table = DeviceTable()
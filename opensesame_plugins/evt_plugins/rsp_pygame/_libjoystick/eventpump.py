@@ -0,0 +1,259 @@
+# -*- coding:utf-8 -*-
+
+"""
+Author: Martin Stokroos, 2024
+
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from libopensesame.py3compat import *
+from collections import deque
+from time import perf_counter
+import functools
+import pygame
+from .devicetable import device_table
+
+# constant
+_PENDING_SIZE = 1024 # max. number of events that wait for a joystick.
+
+# event types
+JOY_EVENTS = (
+    pygame.JOYBUTTONDOWN,
+    pygame.JOYBUTTONUP,
+    pygame.JOYAXISMOTION,
+    pygame.JOYBALLMOTION,
+    pygame.JOYHATMOTION
+)
+_FILTERED_EVENTS = (pygame.JOYAXISMOTION, pygame.JOYHATMOTION)
+DEVICE_EVENTS = (
+    pygame.JOYDEVICEADDED,
+    pygame.JOYDEVICEREMOVED
+)
+
+
+def event_owner(event):
+    """Returns the instance id of the joystick that generated `event`."""
+    return getattr(event, u'instance_id', event.joy)
+
+
+class EventPump:
+    """Takes the joystick events from the pygame event queue and routes them
+    to the joysticks that they belong to.
+
+    Only the requested event types and the key presses are retrieved, so
+    mouse motion, window events and the like stay in the queue for the
+    other items. Key presses other than ESC, and any other event that had to
+    be taken from the queue, are set aside in a side queue and are put back
+    on the pygame queue by `release()`.
+
+    The pump is shared by all joystick instances. Every registered joystick
+    has its own queue, in which the events are kept that were taken from
+    the pygame queue while another joystick was reading. The events are
+    stored as (dequeue time, dequeue ticks, event) tuples, with the dequeue
+    time taken with `perf_counter()` and the ticks, on the clock of the SDL
+    event timestamps, with `pygame.time.get_ticks()`.
+
+    Axis and hat events can be filtered per joystick with `set_filter()`.
+    The events that do not pass are dropped here, so they do not end up in
+    a queue and do not wake up the joystick that waits for input.
+
+    When a joystick is added or removed, the device table is updated and
+    the device listeners are called with the event, so that a joystick that
+    was unplugged can attach again.
+    """
+
+    def __init__(self):
+        self.side_queue = deque()
+        self._pending = {}
+        self._filters = {}
+        self._device_listeners = []
+
+    def add_device_listener(self, callback):
+        """Calls `callback` with every JOYDEVICEADDED and JOYDEVICEREMOVED
+        event."""
+        self._device_listeners.append(callback)
+
+    def remove_device_listener(self, callback):
+        """Stops calling `callback` with the device events."""
+        if callback in self._device_listeners:
+            self._device_listeners.remove(callback)
+
+    def _device_event(self, event):
+        device_table.update()
+        for callback in list(self._device_listeners):
+            callback(event)
+
+    def register(self, instance_id):
+        """Gives joystick `instance_id` its own, empty event queue. Events
+        that are left from a previous registration are dropped."""
+        self._pending[instance_id] = deque(maxlen=_PENDING_SIZE)
+
+    def is_registered(self, instance_id):
+        """Tells whether joystick `instance_id` has its own event queue."""
+        return instance_id in self._pending
+
+    def unregister(self, instance_id):
+        """Removes the event queue and the filter of joystick
+        `instance_id`."""
+        self._pending.pop(instance_id, None)
+        self._filters.pop(instance_id, None)
+
+    def set_filter(self, instance_id, dead_zone=0.0, min_delta=0.0):
+        """Filters the axis and hat events of joystick `instance_id`.
+
+        Parameters
+        ----------
+        instance_id : int
+            The instance id of the joystick.
+        dead_zone : float, optional
+            Axis values closer to zero than this are taken as zero.
+        min_delta : float, optional
+            An axis event is dropped if its value differs less than this from
+            the last value that passed. A return to zero always passes.
+        """
+        if dead_zone <= 0 and min_delta <= 0:
+            self._filters.pop(instance_id, None)
+        else:
+            self._filters[instance_id] = (dead_zone, min_delta, {}, {})
+
+    def _passes(self, event, owner):
+        """Tells whether an axis or hat event passes the filter of its
+        joystick. Hat events only pass when the hat position changes."""
+        try:
+            dead_zone, min_delta, axes, hats = self._filters[owner]
+        except KeyError:
+            return True
+        if event.type == pygame.JOYAXISMOTION:
+            value = 0.0 if abs(event.value) < dead_zone else event.value
+            last = axes.get(event.axis, 0.0)
+            if value == last or (value != 0.0 and abs(value - last) < min_delta):
+                return False
+            axes[event.axis] = value
+        elif event.type == pygame.JOYHATMOTION:
+            if event.value == hats.get(event.hat, (0, 0)):
+                return False
+            hats[event.hat] = event.value
+        return True
+
+    def get(self, eventtypes, instance_id):
+        """Returns the pending events of `eventtypes` of joystick
+        `instance_id` and the pending ESC key presses, as (dequeue time,
+        dequeue ticks, event) tuples."""
+        events = pygame.event.get(
+            eventtype=list(eventtypes) + list(DEVICE_EVENTS) + [pygame.KEYDOWN])
+        return self.dispatch(events, perf_counter(), pygame.time.get_ticks(),
+                             eventtypes, instance_id)
+
+    def dispatch(self, events, t_dequeue, ticks, eventtypes, instance_id):
+        """Routes `events`, taken from the pygame queue at `t_dequeue`, which
+        is `ticks` on the clock of the SDL event timestamps.
+
+        Returns the events of `eventtypes` of joystick `instance_id` that were
+        waiting in its own queue, followed by those in `events` and the ESC
+        key presses. The events of other joysticks go to their own queue and
+        all other events to the side queue.
+        """
+        wanted = []
+        pending = self._pending.get(instance_id)
+        if pending:
+            for i in range(len(pending)):
+                item = pending.popleft()
+                if item[2].type in eventtypes:
+                    wanted.append(item)
+                else:
+                    pending.append(item)
+        for event in events:
+            if event.type in JOY_EVENTS:
+                owner = event_owner(event)
+                if event.type in _FILTERED_EVENTS and not self._passes(event, owner):
+                    continue
+                if owner == instance_id and event.type in eventtypes:
+                    wanted.append((t_dequeue, ticks, event))
+                elif owner in self._pending:
+                    self._pending[owner].append((t_dequeue, ticks, event))
+                else:
+                    self.side_queue.append(event)
+            elif event.type in DEVICE_EVENTS:
+                self._device_event(event)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                wanted.append((t_dequeue, ticks, event))
+            elif event.type != pygame.NOEVENT:
+                self.side_queue.append(event)
+        return wanted
+
+    def unget(self, instance_id, events):
+        """Puts (dequeue time, dequeue ticks, event) tuples that were
+        returned by `get()`, but not used, back in front of the queue of
+        joystick `instance_id`. Other events go to the side queue."""
+        pending = self._pending.get(instance_id)
+        for item in reversed(events):
+            if pending is not None and item[2].type in JOY_EVENTS:
+                pending.appendleft(item)
+            else:
+                self.side_queue.appendleft(item[2])
+
+    def flush(self, instance_id):
+        """Clears the pygame queue and the queue of joystick `instance_id`.
+        The events of the other joysticks are kept.
+
+        Returns
+        -------
+        tuple
+            A (joyinput, escape) tuple, telling whether there was input from
+            the joystick and whether ESC was pressed.
+        """
+        t_dequeue = perf_counter()
+        ticks = pygame.time.get_ticks()
+        joyinput = len(self._pending.get(instance_id, ())) > 0
+        escape = False
+        for event in pygame.event.get():
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                escape = True
+            elif event.type in JOY_EVENTS:
+                owner = event_owner(event)
+                if event.type in _FILTERED_EVENTS and not self._passes(event, owner):
+                    continue
+                if owner == instance_id:
+                    joyinput = True
+                elif owner in self._pending:
+                    self._pending[owner].append((t_dequeue, ticks, event))
+            elif event.type in DEVICE_EVENTS:
+                self._device_event(event)
+        if instance_id in self._pending:
+            self._pending[instance_id].clear()
+        return joyinput, escape
+
+    def release(self):
+        """Puts the events from the side queue back on the pygame queue, in
+        their original order."""
+        side_queue = self.side_queue
+        while side_queue:
+            pygame.event.post(side_queue.popleft())
+
+
+# The pump is shared by all joystick instances.
+event_pump = EventPump()
+
+
+def releases_events(func):
+    """Decorates a method that reads from the event pump, so that the events
+    that were set aside are put back on the queue when the method returns."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            event_pump.release()
+    return wrapper
@@ -22,23 +22,142 @@ along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 from libopensesame.py3compat import *
+from libopensesame.oslogging import oslogger
+from time import perf_counter
 import pygame
 from .basejoystick import BaseJoystick
+from .eventpump import (event_pump, releases_events, JOY_EVENTS)
+from .axisstream import AxisStream
+
+# constant
+_HYBRID_SPIN = 5 # ms that the 'hybrid' wait strategy polls before it starts sleeping.
+_SYNC_TIMEOUT = 0.05 # s, max. time to wait for a tick of the experiment clock.
+_BUTTON_EVENTS = (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP)
 
 
 class Legacy(BaseJoystick):
 
-    def __init__(self, experiment, device=0, joybuttonlist=None, timeout=None):
+    def __init__(self, experiment, device=0, joybuttonlist=None, timeout=None,
+                 wait_strategy=u'spin'):
         """See _libjoystick.basejoystick"""
         self.js = pygame.joystick.Joystick(device)
         self.js.init()
         self.experiment = experiment
+        self._pump = event_pump
+        self._instance_id = self.js.get_instance_id()
+        self._guid = self.js.get_guid()
+        self._attached = True
+        self._dead_zone = 0.0 # no axis filter until set_axis_filter() is called.
+        self._min_delta = 0.0
+        self._pump.register(self._instance_id)
+        self._pump.add_device_listener(self._on_device_event)
+        self._axis_stream = None
         self.set_joybuttonlist(joybuttonlist)
         self.set_timeout(timeout)
+        self.set_wait_strategy(wait_strategy)
+        self._sync_clock()
         pygame.event.set_blocked(pygame.JOYAXISMOTION)
         pygame.event.set_blocked(pygame.JOYHATMOTION)
         pygame.event.set_blocked(pygame.JOYBALLMOTION)
 
+    def _on_device_event(self, event):
+        """Detaches the joystick when it is unplugged and attaches it again
+        when a joystick with the same GUID is plugged in."""
+        if event.type == pygame.JOYDEVICEREMOVED:
+            if self._attached and event.instance_id == self._instance_id:
+                self._attached = False
+                self._pump.unregister(self._instance_id)
+                oslogger.warning(u'Joystick {} has been removed'.format(self._guid))
+        elif not self._attached:
+            js = pygame.joystick.Joystick(event.device_index)
+            if js.get_guid() != self._guid or \
+                    self._pump.is_registered(js.get_instance_id()):
+                return
+            js.init()
+            self.js = js
+            self._instance_id = js.get_instance_id()
+            self._attached = True
+            self._pump.register(self._instance_id)
+            self._pump.set_filter(self._instance_id, self._dead_zone, self._min_delta)
+            oslogger.info(u'Joystick {} has been attached again'.format(self._guid))
+
+    def set_axis_filter(self, dead_zone=0.0, min_delta=0.0):
+        """See _libjoystick.basejoystick"""
+        self._dead_zone = dead_zone
+        self._min_delta = min_delta
+        self._pump.set_filter(self._instance_id, dead_zone, min_delta)
+
+    def _axis_position(self):
+        """Returns the position of all axes, with the dead-zone applied."""
+        pos = []
+        for axis in range(self.js.get_numaxes()):
+            value = self.js.get_axis(axis)
+            pos.append(0.0 if abs(value) < self._dead_zone else value)
+        return pos
+
+    def _sync_clock(self):
+        """Determines the offset between `perf_counter()` and the experiment
+        clock. If the experiment clock has a coarse resolution, this waits for
+        its next tick, so that the offset is not off by a fraction of a tick.
+        """
+        clock_time = self.experiment.clock.time
+        t0 = clock_time()
+        deadline = perf_counter() + _SYNC_TIMEOUT
+        while True:
+            pc = perf_counter()
+            t = clock_time()
+            if t != t0 or pc > deadline:
+                break
+        self._clock_offset = t - 1000 * pc
+
+    def _timestamp(self, t_dequeue, ticks=None, event=None):
+        """Converts a `perf_counter()` time to ms on the experiment clock.
+
+        `t_dequeue` is the time at which the event was taken from the queue
+        and `ticks` the same moment on the clock of the SDL timestamps. If
+        the SDL timestamp of the event shows that it waited in the queue,
+        the time is moved back to the time at which it was queued. The SDL
+        timestamp only has a resolution of 1 ms, so it is only used when the
+        event waited for more than 1 ms.
+        """
+        t = 1000 * t_dequeue + self._clock_offset
+        sdl_time = getattr(event, u'timestamp', None)
+        if sdl_time and ticks is not None:
+            age = ticks - sdl_time
+            if age > 1:
+                t -= age
+        return t
+
+    def _get_events(self, start_time, timeout, eventtypes):
+        """Gets the pending events of `eventtypes` of this joystick and the
+        ESC key presses from the event pump. Depending on the wait strategy,
+        this returns immediately, sleeps for 1 ms when there are no events,
+        or sleeps until an event arrives or the timeout has passed.
+
+        Returns a list of (dequeue time, dequeue ticks, event) tuples, with
+        the dequeue time taken with `perf_counter()` directly after the event
+        was taken from the pygame queue.
+        """
+        events = self._pump.get(eventtypes, self._instance_id)
+        if events or self.wait_strategy == u'spin':
+            return events
+        if self.wait_strategy == u'blocking':
+            if timeout is None:
+                event = pygame.event.wait()
+            else:
+                remaining = int(start_time + timeout - pygame.time.get_ticks())
+                if remaining <= 0:
+                    return events
+                event = pygame.event.wait(remaining)
+            # pygame.event.wait() can not filter, so the event may be of any type.
+            return self._pump.dispatch([event], perf_counter(),
+                                       pygame.time.get_ticks(), eventtypes,
+                                       self._instance_id)
+        if pygame.time.get_ticks() - start_time > _HYBRID_SPIN:
+            pygame.time.wait(1)
+        return events
+
+    @releases_events
     def get_joybutton(self, joybuttonlist=None, timeout=None):
         """See _libjoystick.basejoystick"""
         if joybuttonlist is None or joybuttonlist == []:
@@ -48,8 +167,11 @@ class Legacy(BaseJoystick):
         start_time = pygame.time.get_ticks()
         time = start_time
         while timeout is None or time - start_time <= timeout:
+            # The releases are taken as well, so that they do not pile up in
+            # the queue. Releases before the press are ignored.
+            events = self._get_events(start_time, timeout, _BUTTON_EVENTS)
             time = pygame.time.get_ticks()
-            for event in pygame.event.get():
+            for n, (t_dequeue, ticks, event) in enumerate(events):
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.experiment.pause()
@@ -59,9 +181,30 @@ class Legacy(BaseJoystick):
                             event.button + 1 in joybuttonlist
                     ):
                         bpress = event.button + 1
-                        return bpress, time
-        return None, time
+                        # keep the release of this press for get_joybuttonrelease()
+                        self._pump.unget(self._instance_id, events[n + 1:])
+                        return bpress, self._timestamp(t_dequeue, ticks, event)
+        return None, self._timestamp(perf_counter())
+
+    @releases_events
+    def get_joybuttonrelease(self, joybutton, timeout=None):
+        """See _libjoystick.basejoystick"""
+        start_time = pygame.time.get_ticks()
+        time = start_time
+        while timeout is None or time - start_time <= timeout:
+            events = self._get_events(start_time, timeout, _BUTTON_EVENTS)
+            time = pygame.time.get_ticks()
+            for n, (t_dequeue, ticks, event) in enumerate(events):
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        self.experiment.pause()
+                if event.type == pygame.JOYBUTTONUP and \
+                        event.button + 1 == joybutton:
+                    self._pump.unget(self._instance_id, events[n + 1:])
+                    return joybutton, self._timestamp(t_dequeue, ticks, event)
+        return None, self._timestamp(perf_counter())
 
+    @releases_events
     def get_joyaxes(self, timeout=None):
         """See _libjoystick.basejoystick"""
         pygame.event.set_allowed(pygame.JOYAXISMOTION)
@@ -71,19 +214,20 @@ class Legacy(BaseJoystick):
         start_time = pygame.time.get_ticks()
         time = start_time
         while timeout is None or time - start_time < timeout:
+            events = self._get_events(start_time, timeout, (pygame.JOYAXISMOTION,))
             time = pygame.time.get_ticks()
-            for event in pygame.event.get():
+            for t_dequeue, ticks, event in events:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.experiment.pause()
                 if event.type == pygame.JOYAXISMOTION:
-                    for axis in range(self.js.get_numaxes()):
-                        pos.append(self.js.get_axis(axis))
+                    pos = self._axis_position()
                     pygame.event.set_blocked(pygame.JOYAXISMOTION)
-                    return pos, time
+                    return pos, self._timestamp(t_dequeue, ticks, event)
         pygame.event.set_blocked(pygame.JOYAXISMOTION)
-        return None, time
+        return None, self._timestamp(perf_counter())
 
+    @releases_events
     def get_joyballs(self, timeout=None):
         """See _libjoystick.basejoystick"""
         pygame.event.set_allowed(pygame.JOYBALLMOTION)
@@ -93,8 +237,9 @@ class Legacy(BaseJoystick):
         start_time = pygame.time.get_ticks()
         time = start_time
         while timeout is None or time - start_time < timeout:
+            events = self._get_events(start_time, timeout, (pygame.JOYBALLMOTION,))
             time = pygame.time.get_ticks()
-            for event in pygame.event.get():
+            for t_dequeue, ticks, event in events:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.experiment.pause()
@@ -102,10 +247,11 @@ class Legacy(BaseJoystick):
                     for ball in range(self.js.get_numballs()):
                         ballpos.append(self.js.get_ball(ball))
                     pygame.event.set_blocked(pygame.JOYBALLMOTION)
-                    return ballpos, time
+                    return ballpos, self._timestamp(t_dequeue, ticks, event)
         pygame.event.set_blocked(pygame.JOYBALLMOTION)
-        return None, time
+        return None, self._timestamp(perf_counter())
 
+    @releases_events
     def get_joyhats(self, timeout=None):
         """See _libjoystick.basejoystick"""
         pygame.event.set_allowed(pygame.JOYHATMOTION)
@@ -115,8 +261,9 @@ class Legacy(BaseJoystick):
         start_time = pygame.time.get_ticks()
         time = start_time
         while timeout is None or time - start_time < timeout:
+            events = self._get_events(start_time, timeout, (pygame.JOYHATMOTION,))
             time = pygame.time.get_ticks()
-            for event in pygame.event.get():
+            for t_dequeue, ticks, event in events:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.experiment.pause()
@@ -124,10 +271,11 @@ class Legacy(BaseJoystick):
                     for hat in range(self.js.get_numhats()):
                         hatpos.append(self.js.get_hat(hat))
                     pygame.event.set_blocked(pygame.JOYHATMOTION)
-                    return hatpos, time
+                    return hatpos, self._timestamp(t_dequeue, ticks, event)
         pygame.event.set_blocked(pygame.JOYHATMOTION)
-        return None, time
+        return None, self._timestamp(perf_counter())
 
+    @releases_events
     def get_joyinput(self, joybuttonlist=None, timeout=None):
         """See _libjoystick.basejoystick"""
         pygame.event.set_allowed(pygame.JOYHATMOTION)
@@ -144,8 +292,9 @@ class Legacy(BaseJoystick):
         start_time = pygame.time.get_ticks()
         time = start_time
         while timeout is None or time - start_time <= timeout:
+            events = self._get_events(start_time, timeout, JOY_EVENTS)
             time = pygame.time.get_ticks()
-            for event in pygame.event.get():
+            for t_dequeue, ticks, event in events:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.experiment.pause()
@@ -159,15 +308,14 @@ class Legacy(BaseJoystick):
                         pygame.event.set_blocked(pygame.JOYHATMOTION)
                         pygame.event.set_blocked(pygame.JOYAXISMOTION)
                         pygame.event.set_blocked(pygame.JOYBALLMOTION)
-                        return eventtype, bpress, time
+                        return eventtype, bpress, self._timestamp(t_dequeue, ticks, event)
                 if event.type == pygame.JOYAXISMOTION:
                     eventtype = u'joyaxismotion'
-                    for axis in range(self.js.get_numaxes()):
-                        pos.append(self.js.get_axis(axis))
+                    pos = self._axis_position()
                     pygame.event.set_blocked(pygame.JOYHATMOTION)
                     pygame.event.set_blocked(pygame.JOYAXISMOTION)
                     pygame.event.set_blocked(pygame.JOYBALLMOTION)
-                    return eventtype, pos, time
+                    return eventtype, pos, self._timestamp(t_dequeue, ticks, event)
                 if event.type == pygame.JOYBALLMOTION:
                     eventtype = u'joyballmotion'
                     for ball in range(self.js.get_numballs()):
@@ -175,7 +323,7 @@ class Legacy(BaseJoystick):
                     pygame.event.set_blocked(pygame.JOYHATMOTION)
                     pygame.event.set_blocked(pygame.JOYAXISMOTION)
                     pygame.event.set_blocked(pygame.JOYBALLMOTION)
-                    return eventtype, ballpos, time
+                    return eventtype, ballpos, self._timestamp(t_dequeue, ticks, event)
                 if event.type == pygame.JOYHATMOTION:
                     eventtype = u'joyhatmotion'
                     for hat in range(self.js.get_numhats()):
@@ -183,11 +331,41 @@ class Legacy(BaseJoystick):
                     pygame.event.set_blocked(pygame.JOYHATMOTION)
                     pygame.event.set_blocked(pygame.JOYAXISMOTION)
                     pygame.event.set_blocked(pygame.JOYBALLMOTION)
-                    return eventtype, hatpos, time
+                    return eventtype, hatpos, self._timestamp(t_dequeue, ticks, event)
         pygame.event.set_blocked(pygame.JOYHATMOTION)
         pygame.event.set_blocked(pygame.JOYAXISMOTION)
         pygame.event.set_blocked(pygame.JOYBALLMOTION)
-        return eventtype, None, time
+        return eventtype, None, self._timestamp(perf_counter())
+
+    def start_axis_stream(self, rate=1000, n_samples=10000):
+        """See _libjoystick.basejoystick"""
+        self.stop_axis_stream()
+        self._axis_stream = AxisStream(self.js, rate, n_samples,
+                                       self._clock_offset)
+        self._axis_stream.start()
+        if self.stop_axis_stream not in self.experiment.cleanup_functions:
+            # the sampling thread must not outlive the experiment.
+            self.experiment.cleanup_functions.append(self.stop_axis_stream)
+
+    def stop_axis_stream(self):
+        """See _libjoystick.basejoystick"""
+        if self._axis_stream is not None:
+            self._axis_stream.stop()
+
+    def get_axis_stream(self, n=None):
+        """See _libjoystick.basejoystick"""
+        if self._axis_stream is None:
+            raise ValueError(u'The axis stream has not been started')
+        return self._axis_stream.latest(n)
+
+    def log_axis_stream(self, prefix=u'joystick'):
+        """See _libjoystick.basejoystick"""
+        samples, timestamps = self.get_axis_stream()
+        self.experiment.var.set(prefix + u'_axis_times',
+                                [round(t, 3) for t in timestamps.tolist()])
+        for axis in range(samples.shape[1]):
+            self.experiment.var.set(u'{}_axis{}'.format(prefix, axis),
+                                    [round(v, 4) for v in samples[:, axis].tolist()])
 
     def input_options(self):
         """See _libjoystick.basejoystick"""
@@ -201,15 +379,13 @@ class Legacy(BaseJoystick):
 
     def flush(self):
         """See _libjoystick.basejoystick"""
-        joyinput = False
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                self.experiment.pause()
-            if event.type in (
-                    pygame.JOYBUTTONDOWN,
-                    pygame.JOYAXISMOTION,
-                    pygame.JOYBALLMOTION,
-                    pygame.JOYHATMOTION
-            ):
-                joyinput = True
+        joyinput, escape = self._pump.flush(self._instance_id)
+        if escape:
+            self.experiment.pause()
         return joyinput
+
+    def close(self):
+        """See _libjoystick.basejoystick"""
+        self._pump.remove_device_listener(self._on_device_event)
+        self._pump.unregister(self._instance_id)
+        self._attached = False
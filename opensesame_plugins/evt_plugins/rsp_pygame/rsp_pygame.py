@@ -17,12 +17,21 @@ You should have received a copy of the GNU General Public License
 along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import pygame
+import functools
 from libopensesame.py3compat import *
 from libopensesame.base_response_item import BaseResponseItem
 from openexp.keyboard import Keyboard
 from libopensesame.oslogging import oslogger
 from libqtopensesame.items.qtautoplugin import QtAutoPlugin
+from ._libjoystick.devicetable import device_table
+from .._eventlog import (event_log, text_log, RESPONSE)
+
+
+def close_joysticks(joysticks):
+    """Releases the joysticks of the experiment, so that the shared event
+    pump does not keep them for the next run."""
+    for joystick in joysticks.values():
+        joystick.close()
 
 
 class RspPygame(BaseResponseItem):
@@ -35,6 +44,8 @@ class RspPygame(BaseResponseItem):
         self.var.timeout = u'infinite'
         self.var.allowed_responses = u'1;2'
         self.var.correct_response = u'1'
+        self.var.wait_strategy = u'spin'
+        self.var.end_on_release = u'no'
         self.var.device = u'Keyboard'
 
     def validate_response(self, response):
@@ -45,12 +56,23 @@ class RspPygame(BaseResponseItem):
         return response >= 0 or response <= 255
 
     def _get_button_press(self):
-        r"""Calls libjoystick.get_button_press() with the correct arguments."""
+        r"""Calls libjoystick.get_button_press() with the correct arguments.
+        When the item ends on release, this also waits for the release."""
         # oslogger.info("Button pressed!")
-        return self.experiment.joystick.get_joybutton(
+        button, time = self._joystick.get_joybutton(
             joybuttonlist=self._allowed_responses,
-            timeout=self.var.timeout if type(self.var.timeout) == int else None
+            timeout=self._timeout
         )
+        if button is not None and self._wait_for_release:
+            release_button, release_time = self._joystick.get_joybuttonrelease(button)
+            self._set_release(time, release_time)
+        return button, time
+
+    def _set_release(self, press_time, release_time):
+        """Sets the release time, relative to the item onset, and the hold
+        duration in ms."""
+        self.experiment.var.release_time = release_time - self._t0
+        self.experiment.var.hold_duration = release_time - press_time
 
     def prepare_response_func(self):
         self._keyboard = Keyboard(
@@ -61,15 +83,36 @@ class RspPygame(BaseResponseItem):
             ),
             timeout=self._timeout
         )
+        # release time and hold duration are only measured for joysticks
+        self._wait_for_release = self.var.device != u'Keyboard' and \
+            self.var.end_on_release == u'yes'
+        self.experiment.var.release_time = None
+        self.experiment.var.hold_duration = None
+        # structured event log, if enabled:
+        self._event_log = event_log(self.experiment)
+        if self._event_log is not None:
+            self._log_plugin = self._event_log.plugin_id(self.name)
+            self._log_device = self._event_log.device_id(self.var.device)
+        self._text_log = text_log(self.experiment)
         if self.var.device == u'Keyboard':
             return self._keyboard.get_key
-        # Dynamically load a joystick instance
-        if not hasattr(self.experiment, u'joystick'):
+        # Dynamically load a joystick instance per device. The instances are
+        # shared by all items in a registry on the experiment.
+        if not hasattr(self.experiment, u'joysticks'):
+            self.experiment.joysticks = {}
+            self.experiment.cleanup_functions.append(
+                functools.partial(close_joysticks, self.experiment.joysticks))
+        device_id = int(self.var.device.rsplit(u'_', 1)[1]) # joystick ID from 'joystick-device_<n>'
+        if device_id not in self.experiment.joysticks:
             from .libjoystick import LibJoystick
-            device_id = ord(self.var.device[-1]) - ord('0') # get the last char as int for joystick ID
             oslogger.info("RSP-12x ID: " + str(device_id))
-            self.experiment.joystick = LibJoystick(self.experiment, device=device_id)
-            self.python_workspace[u'joystick'] = self.experiment.joystick
+            self.experiment.joysticks[device_id] = LibJoystick(self.experiment, device=device_id)
+            if not hasattr(self.experiment, u'joystick'):
+                self.experiment.joystick = self.experiment.joysticks[device_id]
+                self.python_workspace[u'joystick'] = self.experiment.joystick
+            self.python_workspace[u'joysticks'] = self.experiment.joysticks
+        self._joystick = self.experiment.joysticks[device_id]
+        self._joystick.set_wait_strategy(self.var.wait_strategy)
         if self._allowed_responses is not None:
             self._allowed_responses = [int(r) for r in self._allowed_responses]
         return self._get_button_press
@@ -79,6 +122,9 @@ class RspPygame(BaseResponseItem):
             self._keyboard.timeout = 0
         else:
             self._timeout = 0
+        # the release is polled below, so that the coroutine does not block
+        wait_for_release = self._wait_for_release
+        self._wait_for_release = False
         alive = True
         yield
         self._t0 = self.set_item_onset()
@@ -87,8 +133,28 @@ class RspPygame(BaseResponseItem):
             if button is not None:
                 break
             alive = yield
+        if button is not None and wait_for_release:
+            while alive:
+                release_button, release_time = \
+                    self._joystick.get_joybuttonrelease(button, timeout=0)
+                if release_button is not None:
+                    self._set_release(time, release_time)
+                    break
+                alive = yield
         self.process_response((button, time))
 
+    def process_response(self, response_args):
+        if self._event_log is not None and self.var.device != u'Keyboard':
+            button, time = response_args
+            self._event_log.add(self._log_plugin, self._log_device, RESPONSE,
+                                -1 if button is None else button,
+                                -1 if time is None else time - self._t0)
+        if self._text_log and self.var.device != u'Keyboard':
+            button, time = response_args
+            oslogger.info('{}: response {} after {} ms'.format(
+                self.name, button, None if time is None else time - self._t0))
+        super().process_response(response_args)
+
 
 class QtRspPygame(RspPygame, QtAutoPlugin):
 
@@ -127,7 +193,7 @@ class QtRspPygame(RspPygame, QtAutoPlugin):
     def refresh_combobox_device(self):
         if self.refresh_checkbox_widget.isChecked():
             # renew list:
-            self.combobox_add_devices()
+            self.combobox_add_devices(refresh=True)
 
     def update_combobox_device(self):
         self.refresh_checkbox_widget.setChecked(False)
@@ -146,24 +212,20 @@ class QtRspPygame(RspPygame, QtAutoPlugin):
             self.timeout_line_edit_widget.setText('')
             self.timeout_line_edit_widget.blockSignals(False)
 
-    def combobox_add_devices(self):
+    def combobox_add_devices(self, refresh=False):
         self.device_combobox_widget.clear()
         self.device_combobox_widget.addItem(u'Keyboard', userData=None)
 
         previous_device_found = False
-        pygame.joystick.init()
-        joycount = pygame.joystick.get_count()
-        for i in range(joycount):
+        # The device table is enumerated once and shared by all items.
+        for i in range(len(device_table.devices(refresh=refresh))):
             # add device(s) to combobox list
             self.device_combobox_widget.addItem("joystick-device_" + str(i))
             # Previous used device present?
-            if ord(self.var.device[-1]) - ord('0') == i:
+            if self.var.device == "joystick-device_" + str(i):
                 previous_device_found = True
-            if i > 8:
-                break
-        pygame.joystick.quit()
 
-        if previous_device_found is False:
+        if previous_device_found is False and self.var.device != u'Keyboard':
             self.var.device = u'Keyboard'
             oslogger.warning("The hardware configuration has been changed since the last run! Switching to Keyboard.")
 
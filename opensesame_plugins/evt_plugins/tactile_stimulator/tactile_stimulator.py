@@ -19,7 +19,9 @@ along with this plug-in.  If not, see <http://www.gnu.org/licenses/>.
 
 from time import (time, sleep)
 import math
-from pyevt import EventExchanger
+from .._devices import (open_devices, find_device, close_devices, instrument_devices)
+from .._qtscan import request_devices
+from .._eventlog import (event_log, text_log, STIMULUS)
 from libopensesame.py3compat import *
 from libopensesame.item import Item
 from libopensesame.oslogging import oslogger
@@ -47,8 +49,6 @@ from openexp.canvas_elements import (
 _DEVICE_GROUP = u'SHOCKER'
 #_DEVICE_GROUP = u'EventExchanger-EVT'
 
-# global var
-open_devices = {} # Store open device handles.
 
 class TactileStimulator(Item):
     """Python module for handling the Tactile Stimulator."""
@@ -74,36 +74,17 @@ class TactileStimulator(Item):
         self.experiment.var.tactstim_pulse_duration_value_ms = self.var.pulse_duration_value
         self.experiment.var.tactstim_pulse_value = 0
 
+        instrument_devices(self.experiment) # measure the device calls, if enabled.
+        # searching for selected device:
+        self.current_device = None
         if self.var.device == u'DUMMY':
             oslogger.warning("Hardware configuration could have changed! Dummy prepare...")
-        elif len(open_devices) == 0:
-            # Create a shadow device list to find 'path' from the current selected device.
-            # 'path' is an unique device ID.
-            temp_evt = EventExchanger()
-            sleep(1) # without a delay, the list will not always be complete.
+        else:
             try:
-                device_list = temp_evt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-                del temp_evt
-                # oslogger.info("device list: {}".format(device_list))
-                for d in device_list:
-                    sleep(1) # without a delays, the device will not always be there.
-                    composed_string = d['product_string'] + " s/n: " + d['serial_number']
-                    open_devices[composed_string] = EventExchanger()
-                    # Get evt device handle:
-                    open_devices[composed_string].attach_id(d['path'])
-                    oslogger.info('Device successfully attached as: {} s/n: {}'.format(
-                        d['product_string'], d['serial_number']))
-                    oslogger.info('        ...  and with device ID: {}'.format(
-                        open_devices[composed_string]))
+                self.current_device = find_device(_DEVICE_GROUP, self.var.device)
             except:
                 oslogger.warning("Connecting the Tactile-stimulator failed! Device set to dummy.")
                 self.var.device = u'DUMMY'
-
-        # searching for selected device:
-        self.current_device = None
-        for dkey in open_devices:
-            if self.var.device[:15] in dkey:
-                self.current_device = dkey # assign to value that belongs to the key.
         if self.current_device is None:
             oslogger.warning("Tactile-stimulator not found! Device set to dummy.")
             self.var.device = u'DUMMY'
@@ -111,6 +92,14 @@ class TactileStimulator(Item):
             oslogger.info('Preparing device: {}'.format(self.current_device))
             open_devices[self.current_device].write_lines(0) # clear lines
 
+        # structured event log, if enabled:
+        self.event_log = event_log(self.experiment)
+        if self.event_log is not None:
+            self.log_plugin = self.event_log.plugin_id(self.name)
+            if self.current_device is not None:
+                self.log_device = self.event_log.device_id(self.current_device)
+        self.text_log = text_log(self.experiment)
+
         # pass device var to experiment as global:
         var_name = "self.experiment.var.connected_device_" + self.name
         exec(f'{var_name} = "{self.var.device}"')
@@ -236,12 +225,7 @@ class TactileStimulator(Item):
 
         # close the device?
         if self.var.close_device == 'yes':
-            for dkey in open_devices:
-                try:
-                    open_devices[dkey].close()
-                    oslogger.info('Device: {} successfully closed!'.format(open_devices[dkey]))
-                except:
-                    oslogger.warning('Device {} for closing not found!'.format(open_devices[dkey]))
+            close_devices([self.current_device])
 
     def calibrate(self):
         slmouse = mouse(self.experiment, timeout=None, visible=True)
@@ -280,6 +264,10 @@ class TactileStimulator(Item):
                 else:
                     open_devices[self.current_device].pulse_lines(math.floor((xperc / 100.0) * self.PULSE_VALUE_MAX),
                                        self.var.pulse_duration_value)
+                    if self.event_log is not None:
+                        self.event_log.add(self.log_plugin, self.log_device, STIMULUS,
+                                           math.floor((xperc / 100.0) * self.PULSE_VALUE_MAX),
+                                           self.var.pulse_duration_value)
                 self.c['Test_Box'].color = 'blue'
                 self.c.show()
                 self.c['wait'].color = 'green'
@@ -332,11 +320,16 @@ class TactileStimulator(Item):
                         self.experiment.var.tactstim_calibration_perc * 5.0 / 10000, 2)
 
                 open_devices[self.current_device].pulse_lines(self.experiment.var.tactstim_pulse_value, self.var.pulse_duration_value)
-                oslogger.info("Device {} now pulsing at "
-                              "(raw, mA): {}, {:.2f}".
-                              format(open_devices[self.current_device],
-                                  self.experiment.var.tactstim_pulse_value,
-                                  self.experiment.var.tactstim_pulse_milliamp))
+                if self.event_log is not None:
+                    self.event_log.add(self.log_plugin, self.log_device, STIMULUS,
+                                       self.experiment.var.tactstim_pulse_value,
+                                       self.var.pulse_duration_value)
+                if self.text_log:
+                    oslogger.info("Device {} now pulsing at "
+                                  "(raw, mA): {}, {:.2f}".
+                                  format(open_devices[self.current_device],
+                                      self.experiment.var.tactstim_pulse_value,
+                                      self.experiment.var.tactstim_pulse_milliamp))
             else:
                 oslogger.warning("In (Hardware) Tactile Stimulator: "
                                  "the next pulse came too early. "
@@ -400,7 +393,7 @@ class QtTactileStimulator(TactileStimulator, QtAutoPlugin):
     def refresh_combobox_device(self):
         if self.refresh_checkbox_widget.isChecked():
             # renew list:
-            self.combobox_add_devices()
+            self.combobox_add_devices(refresh=True)
 
     def update_combobox_device(self):
         self.refresh_checkbox_widget.setChecked(False)
@@ -427,19 +420,17 @@ class QtTactileStimulator(TactileStimulator, QtAutoPlugin):
             self.duration_line_edit_widget.setText('')
             self.duration_line_edit_widget.blockSignals(False)
 
-    def combobox_add_devices(self):
+    def combobox_add_devices(self, refresh=False):
+        # Scan in the background, the combobox is filled when the scan is done.
+        request_devices(_DEVICE_GROUP, self.combobox_fill_devices, refresh)
+
+    def combobox_fill_devices(self, device_list):
+        # Refill the list without triggering the currentIndexChanged signal,
+        # which would apply the intermediate selections to var.device.
+        self.device_combobox_widget.blockSignals(True)
         self.device_combobox_widget.clear()
         self.device_combobox_widget.addItem(u'DUMMY', userData=None)
-        
-        # Create the EVT device list
-        sleep(1) # delay after possible init of a previous instance of this plugin. 
-        myevt = EventExchanger()
-        try:
-            device_list = myevt.scan(_DEVICE_GROUP) # filter on allowed EVT types
-            del myevt
-        except:
-            device_list = {}
-        
+
         try:
             previous_device_found = False
             for d in device_list:
@@ -460,6 +451,10 @@ class QtTactileStimulator(TactileStimulator, QtAutoPlugin):
             self.var.device = u'DUMMY'
             oslogger.warning("The hardware configuration has been changed since the last run! Switching to dummy.")
 
+        self.device_combobox_widget.setCurrentIndex(
+            max(self.device_combobox_widget.findText(self.var.device), 0))
+        self.device_combobox_widget.blockSignals(False)
+
     def close_device(self):
         if self.close_device_checkbox_widget.isChecked():
             self.var.close_device = 'yes'